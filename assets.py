@@ -0,0 +1,164 @@
+"""Fingerprinted, precompressed copies of the files under static/.
+
+Run this module as part of every deploy:
+    python assets.py [--clean]
+
+Each file is copied to static/build/ with a hash of its content in the
+name, e.g. css/styles.3f2a9c0d41be.css, together with .gz and .br (when
+the brotli package is installed) versions of the files that compress.
+manifest.json maps every source name to its copy and the encodings it
+has. The app links to the copies and serves them with an immutable,
+year-long cache lifetime: a changed file gets a new name, so browsers
+never need to revalidate one.
+
+Old copies are kept, and served like new ones, so that pages rendered
+before a deploy still load; --clean removes the ones the new manifest no
+longer uses.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import re
+
+from werkzeug.utils import safe_join
+
+from files import writeFile
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'static')
+BUILD_DIR = os.path.join(STATIC_DIR, 'build')
+MANIFEST_NAME = 'manifest.json'
+
+# File name suffix of each content coding, in order of preference
+SUFFIXES = {'br': 'br', 'gzip': 'gz'}
+
+# Hex digits of the content hash kept in file names
+HASH_LENGTH = 12
+# What fingerprint() makes of a file name
+FINGERPRINTED_NAME = re.compile(
+    r'^[\w.-]+\.[0-9a-f]{%d}(\.\w+)?$' % HASH_LENGTH)
+
+# Formats that are already compressed and gain nothing from gzip
+COMPRESSED_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.webp', '.woff',
+                         '.woff2', '.ico')
+
+
+def fingerprint(name, data):
+    """Returns name with a hash of data before its extension."""
+    root, extension = os.path.splitext(name)
+    digest = hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+    return '%s.%s%s' % (root, digest, extension)
+
+
+def compressions(name, data):
+    """Returns {coding: body} for the encodings that make data smaller."""
+    if name.lower().endswith(COMPRESSED_EXTENSIONS):
+        return {}
+    # Built once per deploy, so use the slowest, smallest settings.
+    # mtime=0 keeps the output the same on every build.
+    bodies = {'gzip': gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        bodies['br'] = brotli.compress(data, quality=11)
+    return {coding: body for coding, body in bodies.items()
+            if len(body) < len(data)}
+
+
+def sourceFiles(static_dir, build_dir):
+    """Yields the names of the files to build, relative to static_dir."""
+    for directory, subdirectories, files in os.walk(static_dir):
+        if os.path.abspath(directory) == os.path.abspath(build_dir):
+            subdirectories[:] = []
+            continue
+        subdirectories.sort()
+        for filename in sorted(files):
+            path = os.path.join(directory, filename)
+            yield os.path.relpath(path, static_dir).replace(os.sep, '/')
+
+
+def buildAssets(static_dir=STATIC_DIR, build_dir=BUILD_DIR):
+    """Writes every asset's copies and the manifest; returns the manifest."""
+    files = {}
+    for name in sourceFiles(static_dir, build_dir):
+        with open(os.path.join(static_dir, name), 'rb') as f:
+            data = f.read()
+        hashed = fingerprint(name, data)
+        path = os.path.join(build_dir, hashed)
+        bodies = compressions(name, data)
+        # Copies never change, so an existing one is already complete
+        if not os.path.exists(path):
+            for coding, body in bodies.items():
+                writeFile('%s.%s' % (path, SUFFIXES[coding]), body)
+            writeFile(path, data)
+        files[name] = {'path': hashed, 'encodings': sorted(bodies)}
+
+    # The version changes whenever any asset does
+    version = hashlib.sha256(json.dumps(
+        files, sort_keys=True).encode('utf-8')).hexdigest()[:HASH_LENGTH]
+    manifest = {'version': version, 'files': files}
+    writeFile(os.path.join(build_dir, MANIFEST_NAME), json.dumps(
+        manifest, indent=2, sort_keys=True).encode('utf-8'))
+    return manifest
+
+
+def cleanAssets(manifest, build_dir=BUILD_DIR):
+    """Removes copies that manifest doesn't use; returns how many."""
+    used = {MANIFEST_NAME}
+    for entry in manifest['files'].values():
+        used.add(entry['path'])
+        used.update('%s.%s' % (entry['path'], SUFFIXES[coding])
+                    for coding in entry['encodings'])
+    removed = 0
+    for directory, subdirectories, files in os.walk(build_dir):
+        for filename in files:
+            path = os.path.join(directory, filename)
+            name = os.path.relpath(path, build_dir).replace(os.sep, '/')
+            if name not in used:
+                os.remove(path)
+                removed += 1
+    return removed
+
+
+def loadManifest(build_dir=BUILD_DIR):
+    """Returns the manifest of the last build, or None if there is none."""
+    try:
+        with open(os.path.join(build_dir, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def findCopy(name, build_dir=BUILD_DIR):
+    """Returns (path, encodings) of the copy called name, or None.
+
+    Copies from any build are found, not just those in the manifest.
+    """
+    path = safe_join(build_dir, name)
+    if path is None or not FINGERPRINTED_NAME.match(
+            os.path.basename(path)) or not os.path.isfile(path):
+        return None
+    encodings = [coding for coding, suffix in SUFFIXES.items()
+                 if os.path.isfile('%s.%s' % (path, suffix))]
+    return path, encodings
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--clean', action='store_true',
+                        help='remove copies the new manifest does not use')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parseArgs()
+    manifest = buildAssets()
+    print('%d assets built, version %s' % (
+        len(manifest['files']), manifest['version']))
+    if args.clean:
+        print('%d unused copies removed' % cleanAssets(manifest))
@@ -0,0 +1,207 @@
+"""Batch create, update and delete of items for the JSON API.
+
+A batch is a list of operations:
+    {"op": "create", "name": ..., "description": ..., "category_id": ...}
+    {"op": "update", "id": ..., plus any of name, description, category_id}
+    {"op": "delete", "id": ...}
+
+Every operation is checked before anything is written: categories against
+the cached category list, and the items to update or delete with one
+owner query per LOOKUP_CHUNK_SIZE ids. The checks run under the write
+lock, so no item can change between being checked and being written. If
+all of them are valid they are applied in the same transaction with one
+executemany per statement type.
+"""
+import datetime
+import os
+
+from sqlalchemy import bindparam, false, func
+
+from db_setup import Item
+
+OPERATIONS = ('create', 'update', 'delete')
+
+# Most operations accepted in one request
+BATCH_MAX_OPERATIONS = int(os.environ.get('API_BATCH_MAX_OPERATIONS',
+                                          100000))
+
+# Ids per owner query, well below SQLite's limit on bound parameters
+LOOKUP_CHUNK_SIZE = 10000
+
+# Rows per executemany statement
+WRITE_CHUNK_SIZE = 1000
+
+UPDATE_STATEMENT = Item.__table__.update().where(
+    Item.id == bindparam('b_id')).where(
+    Item.user_id == bindparam('b_user_id')).values(
+    # A missing field keeps its value, like an empty field in the edit form
+    name=func.coalesce(bindparam('b_name'), Item.name),
+    description=func.coalesce(bindparam('b_description'), Item.description),
+    category_id=func.coalesce(bindparam('b_category_id'), Item.category_id),
+    updated_at=bindparam('b_updated_at'))
+
+
+# Changes no row, but on SQLite still takes the database's write lock
+LOCK_STATEMENT = Item.__table__.update().where(false()).values(id=Item.id)
+
+
+def chunked(values, size):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def isInteger(value):
+    # JSON true and false arrive as bools, which are ints in Python
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def checkFields(operation, category_ids):
+    """Returns what is wrong with an operation's fields, or None."""
+    creating = operation['op'] == 'create'
+    name = operation.get('name')
+    if name is None:
+        if creating:
+            return 'name is required'
+    elif not isinstance(name, str) or not name.strip():
+        return 'name must be a non-empty string'
+
+    description = operation.get('description')
+    if description is not None and not isinstance(description, str):
+        return 'description must be a string'
+
+    category_id = operation.get('category_id')
+    if category_id is None:
+        if creating:
+            return 'category_id is required'
+    elif not isInteger(category_id) or category_id not in category_ids:
+        return 'category_id is not an existing category'
+    return None
+
+
+def lockForWrite(db_session):
+    """Keeps other writers out until the caller's transaction ends.
+
+    SQLite has a single write lock, which any write takes. Other databases
+    lock the rows loadOwners reads instead.
+    """
+    if db_session.get_bind().dialect.name == 'sqlite':
+        db_session.execute(LOCK_STATEMENT)
+
+
+def loadOwners(db_session, item_ids):
+    """Returns {id: (user_id, category_id)} for the items that exist."""
+    owners = {}
+    for chunk in chunked(item_ids, LOOKUP_CHUNK_SIZE):
+        # SQLite ignores FOR UPDATE; lockForWrite has already locked it
+        for row in db_session.query(
+                Item.id, Item.user_id, Item.category_id).filter(
+                Item.id.in_(chunk)).with_for_update():
+            owners[row.id] = (row.user_id, row.category_id)
+    return owners
+
+
+def validateBatch(db_session, operations, category_ids, user_id):
+    """Checks every operation of a batch.
+
+    Returns a list with an error message or None for each operation, and
+    the owners of the items the batch updates or deletes. The caller must
+    have called lockForWrite in the same transaction.
+    """
+    errors = []
+    seen = set()
+    for operation in operations:
+        if not isinstance(operation, dict):
+            errors.append('operation must be an object')
+            continue
+        if operation.get('op') not in OPERATIONS:
+            errors.append('op must be create, update or delete')
+            continue
+        if operation['op'] != 'create':
+            item_id = operation.get('id')
+            if not isInteger(item_id):
+                errors.append('id must be an integer')
+                continue
+            if item_id in seen:
+                errors.append('item appears in more than one operation')
+                continue
+            seen.add(item_id)
+        if operation['op'] == 'delete':
+            errors.append(None)
+        else:
+            errors.append(checkFields(operation, category_ids))
+
+    owners = loadOwners(db_session, sorted(seen))
+    for n, operation in enumerate(operations):
+        if errors[n] is not None or operation['op'] == 'create':
+            continue
+        owner = owners.get(operation['id'])
+        if owner is None:
+            errors[n] = 'item not found'
+        elif owner[0] != user_id:
+            # The same rule edit and delete apply
+            errors[n] = 'only the owner can change this item'
+    return errors, owners
+
+
+def touchedCategories(operations, owners):
+    """Returns the ids of every category a valid batch changes."""
+    category_ids = set()
+    for operation in operations:
+        if operation['op'] != 'create':
+            category_ids.add(owners[operation['id']][1])
+        if operation.get('category_id') is not None:
+            category_ids.add(operation['category_id'])
+    return category_ids
+
+
+def applyBatch(db_session, operations, user_id):
+    """Writes a validated batch in the caller's transaction.
+
+    Returns a result for each operation and the ids of the items that
+    were written and deleted. The caller must hold the lock that
+    validateBatch was called under.
+    """
+    now = datetime.datetime.now()
+    table = Item.__table__
+    creates = [o for o in operations if o['op'] == 'create']
+    updates = [o for o in operations if o['op'] == 'update']
+    deletes = [o['id'] for o in operations if o['op'] == 'delete']
+
+    rows = [{'name': o['name'], 'description': o.get('description'),
+             'category_id': o['category_id'], 'user_id': user_id,
+             'created_at': now, 'updated_at': now} for o in creates]
+    if rows and db_session.get_bind().dialect.name == 'sqlite':
+        # Under SQLite's write lock every new rowid is the largest one plus
+        # one, so the new ids follow the current largest in insert order
+        last_id = db_session.query(Item.id).order_by(
+            Item.id.desc()).limit(1).scalar() or 0
+        for chunk in chunked(rows, WRITE_CHUNK_SIZE):
+            db_session.execute(table.insert(), chunk)
+        new_ids = [row.id for row in db_session.query(Item.id).filter(
+            Item.id > last_id).order_by(Item.id)]
+    else:
+        # Other databases hand out ids to concurrent inserts interleaved
+        new_ids = [db_session.execute(
+            table.insert(), row).inserted_primary_key[0] for row in rows]
+    for operation, item_id in zip(creates, new_ids):
+        operation['id'] = item_id
+
+    if updates:
+        rows = [{'b_id': o['id'], 'b_user_id': user_id,
+                 'b_name': o.get('name'),
+                 'b_description': o.get('description'),
+                 'b_category_id': o.get('category_id'),
+                 'b_updated_at': now} for o in updates]
+        for chunk in chunked(rows, WRITE_CHUNK_SIZE):
+            db_session.execute(UPDATE_STATEMENT, chunk)
+
+    for chunk in chunked(deletes, LOOKUP_CHUNK_SIZE):
+        db_session.execute(table.delete().where(
+            Item.id.in_(chunk)).where(Item.user_id == user_id))
+
+    statuses = {'create': 'created', 'update': 'updated',
+                'delete': 'deleted'}
+    results = [{'op': o['op'], 'id': o['id'], 'status': statuses[o['op']]}
+               for o in operations]
+    written = [o['id'] for o in creates + updates]
+    return results, written, deletes
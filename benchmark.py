@@ -0,0 +1,342 @@
+"""Latency benchmark for the routes in main.py.
+
+A scratch database is seeded with a synthetic catalog (see seed_db.py) and
+every route is requested through the Flask test client, or through a local
+WSGI server with --server. The create, edit and delete routes run as a
+logged in user with a stubbed session.
+
+For each route p50/p95/p99 latency, requests/sec, SQL queries per request
+and peak RSS are printed and can be written as JSON with --output. With
+--compare the results are checked against a stored baseline and the exit
+status is 1 if any route got slower or issues more queries.
+
+    python benchmark.py --items 100000 --output baseline.json
+    python benchmark.py --items 100000 --compare baseline.json
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode
+
+# CSRF token stored in the stubbed session and sent with every form
+CSRF_TOKEN = 'benchmark'
+
+
+def percentile(samples, fraction):
+    """Returns the nearest-rank percentile of a sorted list."""
+    index = int(round(fraction * (len(samples) - 1)))
+    return samples[index]
+
+
+def peakRSS():
+    """Returns the peak resident set size of this process in kilobytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux kilobytes
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+class TestClient(object):
+    """Sends requests through Flask's test client."""
+
+    def __init__(self, app, session):
+        self.client = app.test_client()
+        with self.client.session_transaction() as s:
+            s.update(session)
+
+    def get(self, path):
+        response = self.client.get(path)
+        # Read the body so streamed responses are generated in full
+        response.get_data()
+        return response.status_code
+
+    def post(self, path, data):
+        return self.client.post(path, data=data).status_code
+
+
+class ServerClient(object):
+    """Sends requests to the app running in a local WSGI server."""
+
+    def __init__(self, app, session):
+        from werkzeug.serving import make_server
+
+        self.server = make_server('127.0.0.1', 0, app, threaded=True)
+        self.port = self.server.server_port
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        # Sign the stubbed session the same way Flask does
+        serializer = app.session_interface.get_signing_serializer(app)
+        self.cookie = '%s=%s' % (app.config['SESSION_COOKIE_NAME'],
+                                 serializer.dumps(dict(session)))
+
+    def request(self, method, path, body=None):
+        headers = {'Cookie': self.cookie}
+        if body is not None:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        connection = http.client.HTTPConnection('127.0.0.1', self.port)
+        try:
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            response.read()
+            return response.status
+        finally:
+            connection.close()
+
+    def get(self, path):
+        return self.request('GET', path)
+
+    def post(self, path, data):
+        return self.request('POST', path, urlencode(data))
+
+    def close(self):
+        self.server.shutdown()
+
+
+def seedCatalog(args, database_url):
+    """Fills the benchmark database and returns the benchmark user's id."""
+    import seed_db
+    from db_setup import User, createSchema
+
+    seed_db.connect(database_url)
+    createSchema(seed_db.engine)
+
+    seed = argparse.Namespace(
+        users=args.users, categories=args.categories, items=args.items,
+        description_words=args.description_words, chunk_size=5000,
+        transaction_size=100000, no_indexes=True, seed=args.seed)
+    seed_db.seedSynthetic(seed)
+
+    db_session = seed_db.DBSession()
+    user = User(name='Benchmark User', email='benchmark@example.com')
+    db_session.add(user)
+    db_session.commit()
+    user_id = user.id
+    db_session.close()
+    return user_id
+
+
+def buildScenarios(db_session, rng, requests):
+    """Returns (name, method, [(path, data), ...]) for every route."""
+    from db_setup import Category, Item
+
+    category_ids = [c.id for c in db_session.query(Category.id)]
+    items = db_session.query(Item.id, Item.category_id).order_by(
+        Item.id).limit(10000).all()
+    sample = [rng.choice(items) for _ in range(requests)]
+    categories = [rng.choice(category_ids) for _ in range(requests)]
+
+    def form(category_id, name):
+        return {'category': category_id, 'name': name,
+                'description': 'Benchmark description', '_csrf_token':
+                CSRF_TOKEN}
+
+    return [
+        ('index', 'GET', [('/', None)] * requests),
+        ('displayCategory', 'GET',
+         [('/catalog/%d' % c, None) for c in categories]),
+        ('displayItem', 'GET',
+         [('/catalog/%d/%d' % (i.category_id, i.id), None)
+          for i in sample]),
+        ('indexJSON', 'GET', [('/api', None)] * max(1, requests // 20)),
+        ('indexJSON_page', 'GET', [('/api?limit=100', None)] * requests),
+        ('categoryAPI', 'GET', [('/api/%d' % c, None) for c in categories]),
+        ('categoryAPI_page', 'GET',
+         [('/api/%d?limit=100' % c, None) for c in categories]),
+        ('itemAPI', 'GET',
+         [('/api/%d/%d' % (i.category_id, i.id), None) for i in sample]),
+        ('createNew', 'POST',
+         [('/catalog/%d/new' % c, form(c, 'Benchmark %d' % n))
+          for n, c in enumerate(categories)]),
+    ]
+
+
+def run(client, engine, name, method, calls, warmup, cold, cache):
+    """Times every call of a scenario and returns its statistics."""
+    from sqlalchemy import event
+
+    queries = [0]
+
+    def countQuery(*args):
+        queries[0] += 1
+
+    for path, data in calls[:warmup]:
+        if method == 'GET':
+            client.get(path)
+        else:
+            client.post(path, data)
+
+    event.listen(engine, 'before_cursor_execute', countQuery)
+    latencies = []
+    errors = 0
+    started = time.perf_counter()
+    for path, data in calls:
+        if cold:
+            cache.invalidate()
+        before = time.perf_counter()
+        if method == 'GET':
+            status = client.get(path)
+        else:
+            status = client.post(path, data)
+        latencies.append(time.perf_counter() - before)
+        if status >= 400:
+            errors += 1
+    elapsed = time.perf_counter() - started
+    event.remove(engine, 'before_cursor_execute', countQuery)
+
+    latencies.sort()
+    return {
+        'route': name,
+        'requests': len(calls),
+        'errors': errors,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'requests_per_sec': len(calls) / elapsed,
+        'queries_per_request': float(queries[0]) / len(calls),
+        'peak_rss_kb': peakRSS()
+    }
+
+
+def writeScenarios(db_session, user_id, created_name):
+    """Returns edit and delete scenarios for the items createNew made."""
+    from db_setup import Item
+
+    items = db_session.query(Item.id, Item.category_id).filter(
+        Item.user_id == user_id,
+        Item.name.like(created_name + '%')).all()
+    return [
+        ('edit', 'POST',
+         [('/catalog/%d/edit' % i.id,
+           {'category': i.category_id, 'name': 'Edited %d' % i.id,
+            'description': '', '_csrf_token': CSRF_TOKEN})
+          for i in items]),
+        ('delete', 'POST',
+         [('/catalog/%d/delete' % i.id, {'_csrf_token': CSRF_TOKEN})
+          for i in items]),
+    ]
+
+
+def printResults(results):
+    print('%-18s %9s %9s %9s %10s %8s %6s' % (
+        'route', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s', 'queries', 'errors'))
+    for r in results:
+        print('%-18s %9.2f %9.2f %9.2f %10.1f %8.1f %6d' % (
+            r['route'], r['p50_ms'], r['p95_ms'], r['p99_ms'],
+            r['requests_per_sec'], r['queries_per_request'], r['errors']))
+
+
+def compare(results, baseline, threshold):
+    """Prints regressions against a baseline run; returns their number."""
+    previous = dict((r['route'], r) for r in baseline['results'])
+    regressions = 0
+    for r in results:
+        old = previous.get(r['route'])
+        if old is None:
+            continue
+        problems = []
+        if r['p95_ms'] > old['p95_ms'] * (1 + threshold):
+            problems.append('p95 %.2fms -> %.2fms' % (
+                old['p95_ms'], r['p95_ms']))
+        if r['requests_per_sec'] < old['requests_per_sec'] * (1 - threshold):
+            problems.append('req/s %.1f -> %.1f' % (
+                old['requests_per_sec'], r['requests_per_sec']))
+        if r['queries_per_request'] > old['queries_per_request']:
+            problems.append('queries %.1f -> %.1f' % (
+                old['queries_per_request'], r['queries_per_request']))
+        if problems:
+            regressions += 1
+            print('REGRESSION %s: %s' % (r['route'], ', '.join(problems)))
+    return regressions
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--categories', type=int, default=20)
+    parser.add_argument('--items', type=int, default=10000)
+    parser.add_argument('--description-words', type=int, default=150)
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per route')
+    parser.add_argument('--warmup', type=int, default=10,
+                        help='untimed requests per route')
+    parser.add_argument('--cold', action='store_true',
+                        help='empty the read cache before every request')
+    parser.add_argument('--server', action='store_true',
+                        help='send requests to a local WSGI server')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results to this file')
+    parser.add_argument('--compare', help='baseline results to compare to')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='allowed slowdown before a route is flagged')
+    return parser.parse_args()
+
+
+def main():
+    args = parseArgs()
+    workdir = tempfile.mkdtemp()
+    database_url = 'sqlite:///' + os.path.join(workdir, 'catalog.db')
+
+    user_id = seedCatalog(args, database_url)
+
+    import main as catalog
+
+    app = catalog.create_app({'DATABASE_URL': database_url,
+                              'SECRET_KEY': 'benchmark'})
+    state = app.extensions['catalog']
+    session = {'username': 'Benchmark User', 'user_id': user_id,
+               'picture': '', '_csrf_token': CSRF_TOKEN}
+    if args.server:
+        client = ServerClient(app, session)
+    else:
+        client = TestClient(app, session)
+
+    rng = random.Random(args.seed)
+    db_session = state.DBSession()
+    scenarios = buildScenarios(db_session, rng, args.requests)
+    results = []
+    for name, method, calls in scenarios:
+        results.append(run(client, state.engine, name, method, calls,
+                           args.warmup, args.cold, state.read_cache))
+    for name, method, calls in writeScenarios(db_session, user_id,
+                                              'Benchmark'):
+        results.append(run(client, state.engine, name, method, calls,
+                           0, args.cold, state.read_cache))
+    db_session.close()
+    if args.server:
+        client.close()
+
+    printResults(results)
+    print('peak RSS: %d KB' % peakRSS())
+
+    report = {
+        'settings': {
+            'users': args.users, 'categories': args.categories,
+            'items': args.items, 'requests': args.requests,
+            'cold': args.cold, 'server': args.server
+        },
+        'peak_rss_kb': peakRSS(),
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            return 1
+        print('no regressions against %s' % args.compare)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
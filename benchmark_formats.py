@@ -0,0 +1,173 @@
+"""Compares the API's response formats and compressions.
+
+A scratch database is seeded with a synthetic catalog (see seed_db.py) and
+every JSON API route is requested in each format and content coding the
+app supports, next to the old path that loads ORM objects and encodes
+their Item.serialize dicts with jsonify. For each variant the bytes on
+the wire, the median request time and the time spent only encoding and
+compressing the body are printed.
+
+    python benchmark_formats.py --items 100000 --description-words 150
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from benchmark import percentile, seedCatalog
+
+
+def legacyRoutes(catalog, app):
+    """Adds the ORM and jsonify version of each API route under /legacy."""
+    from flask import jsonify
+    from db_setup import Category, Item
+
+    def allItems():
+        categories = catalog.db_session.query(Category).all()
+        data = []
+        for c in categories:
+            items = catalog.db_session.query(Item).filter_by(
+                category_id=c.id).all()
+            data.append(dict(c.serialize,
+                             Items=[i.serialize for i in items]))
+        return {'Categories': data}
+
+    def categoryItems(category_id):
+        items = catalog.db_session.query(Item).filter_by(
+            category_id=category_id).all()
+        return {'Items': [i.serialize for i in items]}
+
+    def item(item_id):
+        return {'Item': catalog.db_session.query(Item).filter_by(
+            id=item_id).first().serialize}
+
+    app.add_url_rule(
+        '/legacy/api', 'legacyIndex', lambda: jsonify(**allItems()))
+    app.add_url_rule(
+        '/legacy/api/<int:category_id>', 'legacyCategory',
+        lambda category_id: jsonify(**categoryItems(category_id)))
+    app.add_url_rule(
+        '/legacy/api/<int:category_id>/<int:item_id>', 'legacyItem',
+        lambda category_id, item_id: jsonify(**item(item_id)))
+    return {'index': allItems, 'category': categoryItems, 'item': item}
+
+
+def variants():
+    """Returns (name, request headers) for every format and coding."""
+    import formats
+
+    result = [('json', {}), ('json gzip', {'Accept-Encoding': 'gzip'})]
+    if formats.brotli is not None:
+        result.append(('json br', {'Accept-Encoding': 'br'}))
+    if formats.msgpack is not None:
+        msgpack = {'Accept': formats.MSGPACK}
+        result.append(('msgpack', msgpack))
+        result.append(('msgpack gzip', dict(msgpack,
+                                            **{'Accept-Encoding': 'gzip'})))
+        if formats.brotli is not None:
+            result.append(('msgpack br', dict(msgpack,
+                                              **{'Accept-Encoding': 'br'})))
+    return result
+
+
+def timeRequests(client, path, headers, requests):
+    """Returns (body size, median seconds) of requests to path."""
+    timings = []
+    size = 0
+    for _ in range(requests):
+        started = time.perf_counter()
+        response = client.get(path, headers=headers)
+        size = len(response.get_data())
+        timings.append(time.perf_counter() - started)
+        if response.status_code != 200:
+            raise SystemExit('%s returned %d' % (path, response.status_code))
+    timings.sort()
+    return size, percentile(timings, 0.5)
+
+
+def timeEncoding(encode, requests):
+    """Returns the median seconds encode() takes."""
+    timings = []
+    for _ in range(requests):
+        started = time.perf_counter()
+        encode()
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return percentile(timings, 0.5)
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--categories', type=int, default=20)
+    parser.add_argument('--items', type=int, default=10000)
+    parser.add_argument('--description-words', type=int, default=150)
+    parser.add_argument('--requests', type=int, default=20,
+                        help='requests per route and variant')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def main():
+    args = parseArgs()
+    workdir = tempfile.mkdtemp()
+    database_url = 'sqlite:///' + os.path.join(workdir, 'catalog.db')
+
+    seedCatalog(args, database_url)
+
+    import formats
+    import main as catalog
+    from db_setup import Item
+
+    app = catalog.create_app({'DATABASE_URL': database_url,
+                              'SECRET_KEY': 'benchmark'})
+    legacy = legacyRoutes(catalog, app)
+    client = app.test_client()
+
+    db_session = app.extensions['catalog'].DBSession()
+    item = db_session.query(Item.id, Item.category_id).order_by(
+        Item.id).first()
+    db_session.close()
+    category_id, item_id = item.category_id, item.id
+    routes = [
+        ('/api', legacy['index'], ()),
+        ('/api/%d' % category_id, legacy['category'], (category_id,)),
+        ('/api/%d/%d' % (category_id, item_id), legacy['item'],
+         (item_id,)),
+    ]
+
+    print('%-10s %-14s %12s %10s %10s' % (
+        'route', 'variant', 'bytes', 'req ms', 'encode ms'))
+    for path, load, load_args in routes:
+        with app.app_context():
+            payload = load(*load_args)
+
+            size, elapsed = timeRequests(
+                client, '/legacy' + path, {}, args.requests)
+            encoding = timeEncoding(
+                lambda: app.json.response(payload).get_data(),
+                args.requests)
+            print('%-10s %-14s %12d %10.2f %10.2f' % (
+                path, 'legacy', size, elapsed * 1000, encoding * 1000))
+
+            for name, headers in variants():
+                size, elapsed = timeRequests(
+                    client, path, headers, args.requests)
+                mimetype = headers.get('Accept', formats.JSON)
+                coding = headers.get('Accept-Encoding')
+
+                def encode():
+                    body = formats.encode(payload, mimetype)
+                    if coding and len(body) >= formats.COMPRESS_MIN_SIZE:
+                        body = formats.compressBody(body, coding)
+                    return body
+
+                encoding = timeEncoding(encode, args.requests)
+                print('%-10s %-14s %12d %10.2f %10.2f' % (
+                    path, name, size, elapsed * 1000, encoding * 1000))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
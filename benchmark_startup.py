@@ -0,0 +1,129 @@
+"""Startup benchmark for main.py.
+
+Every run starts a new Python process, as a freshly started worker would,
+and times importing main, create_app() and the first and second request
+to --path. The process's total time includes starting the interpreter.
+A scratch database with the sample catalog (see seed_db.py) is used.
+
+The medians and p95s of all runs are printed, along with the slowest
+modules `import main` loads, so that a new eager import of a heavy
+library shows up.
+
+    python benchmark_startup.py --runs 20
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmark import percentile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Runs in each child process and prints its timings as JSON
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+app = main.create_app({'DATABASE_URL': sys.argv[1],
+                       'SECRET_KEY': 'benchmark'})
+created = time.perf_counter()
+client = app.test_client()
+status = client.get(sys.argv[2]).status_code
+first = time.perf_counter()
+client.get(sys.argv[2])
+second = time.perf_counter()
+print(json.dumps({
+    'import': imported - started, 'create_app': created - imported,
+    'first_request': first - created, 'second_request': second - first,
+    'status': status, 'modules': len(sys.modules),
+    'oauth_loaded': 'oauth2client' in sys.modules}))
+"""
+
+
+def seedDatabase(database_url):
+    import seed_db
+    from db_setup import createSchema
+
+    seed_db.connect(database_url)
+    createSchema(seed_db.engine)
+    seed_db.seedAnime()
+
+
+def runProbe(database_url, path):
+    """Starts a process that imports the app; returns its timings."""
+    started = time.perf_counter()
+    output = subprocess.check_output(
+        [sys.executable, '-c', PROBE, database_url, path], cwd=HERE)
+    timings = json.loads(output)
+    timings['process'] = time.perf_counter() - started
+    return timings
+
+
+def slowestImports(count):
+    """Returns (milliseconds, module) of the slowest top-level imports."""
+    output = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import main'],
+        cwd=HERE, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL,
+        universal_newlines=True, check=True).stderr
+    imports = []
+    for line in output.splitlines():
+        fields = line.split('|')
+        # Direct imports of the -c script are indented by one level
+        if len(fields) == 3 and fields[2].startswith('   ') and \
+                not fields[2].startswith('    '):
+            try:
+                imports.append((int(fields[1]) / 1000.0, fields[2].strip()))
+            except ValueError:
+                continue
+    imports.sort(reverse=True)
+    return imports[:count]
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=10,
+                        help='processes to start')
+    parser.add_argument('--path', default='/',
+                        help='path of the first request')
+    parser.add_argument('--imports', type=int, default=10,
+                        help='number of slowest imports to list')
+    return parser.parse_args()
+
+
+def main():
+    args = parseArgs()
+    workdir = tempfile.mkdtemp()
+    database_url = 'sqlite:///' + os.path.join(workdir, 'catalog.db')
+    seedDatabase(database_url)
+
+    runs = [runProbe(database_url, args.path) for _ in range(args.runs)]
+    if any(r['status'] >= 400 for r in runs):
+        print('%s returned %d' % (args.path, runs[0]['status']))
+        return 1
+
+    print('%-16s %9s %9s' % ('phase', 'p50 ms', 'p95 ms'))
+    for phase in ('import', 'create_app', 'first_request',
+                  'second_request', 'process'):
+        timings = sorted(r[phase] for r in runs)
+        print('%-16s %9.1f %9.1f' % (
+            phase, percentile(timings, 0.5) * 1000,
+            percentile(timings, 0.95) * 1000))
+    print('modules loaded: %d' % runs[0]['modules'])
+
+    print('\nslowest imports of main:')
+    for elapsed, module in slowestImports(args.imports):
+        print('%9.1f ms  %s' % (elapsed, module))
+
+    if runs[0]['oauth_loaded']:
+        print('\nthe OAuth client libraries were loaded at startup')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
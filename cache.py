@@ -0,0 +1,72 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class ReadCache(object):
+    """Bounded in-process LRU cache with a TTL and a generation counter.
+
+    Every entry remembers the generation it was loaded in. Write paths call
+    invalidate() to bump the generation, which makes all older entries
+    misses, so a worker never serves data older than its own last write.
+    Other worker processes only catch up once the TTL expires.
+    """
+
+    def __init__(self, max_entries=256, ttl=60.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, loader):
+        """Returns the cached value for key, calling loader() on a miss."""
+        now = time.monotonic()
+        with self._lock:
+            generation = self.generation
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, entry_generation, expires_at = entry
+                if entry_generation == generation and expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+
+        # Load outside the lock so slow queries don't block other readers
+        value = loader()
+
+        with self._lock:
+            # A write during the load makes this value stale; don't keep it
+            if generation == self.generation:
+                self._entries[key] = (value, generation, now + self.ttl)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return value
+
+    def discard(self, key):
+        """Drops a single entry, if it is cached."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate(self):
+        """Discards every cached entry by starting a new generation."""
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        """Returns the hit/miss counters and current size."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'generation': self.generation
+            }
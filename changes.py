@@ -0,0 +1,115 @@
+"""Change feed of item writes for clients that mirror the catalog.
+
+createNew, edit and delete add an ItemChange row (see db_setup.py) in the
+same transaction as the write itself, so the feed never misses or invents
+a change. The feed reports each changed item's current state, or a
+tombstone if it has been deleted, so only the latest change of an item
+matters and compaction can drop all earlier ones.
+
+SQLite runs one write transaction at a time, so changes commit in seq
+order and a client that remembers the last seq it saw misses nothing.
+That only holds on SQLite: databases that commit concurrent transactions
+can make a smaller seq visible after a larger one, which such a client
+skips.
+
+Run this module to compact the change log of an existing database:
+    python changes.py
+"""
+import datetime
+import os
+
+from sqlalchemy import func, text
+
+from db_setup import Item, ItemChange
+
+# Changes returned when no limit is given, and the maximum
+CHANGES_LIMIT = 100
+CHANGES_MAX_LIMIT = 1000
+
+# The write paths compact the log after every this many changes
+COMPACT_EVERY = int(os.environ.get('CATALOG_CHANGES_COMPACT_EVERY', 1000))
+
+# Deletes every change that a later change of the same item supersedes
+COMPACT_QUERY = text("""
+    DELETE FROM item_change
+    WHERE seq NOT IN (
+        SELECT max(seq) FROM item_change GROUP BY item_id
+    )
+""")
+
+
+def recordChange(db_session, item_id, deleted=False):
+    """Logs a write to an item in the caller's transaction."""
+    change = ItemChange(item_id=item_id, deleted=deleted,
+                        changed_at=datetime.datetime.now())
+    db_session.add(change)
+    return change
+
+
+def recordChanges(db_session, item_ids, deleted=False):
+    """Logs writes to many items with one executemany."""
+    now = datetime.datetime.now()
+    rows = [{'item_id': item_id, 'deleted': deleted, 'changed_at': now}
+            for item_id in item_ids]
+    if rows:
+        db_session.execute(ItemChange.__table__.insert(), rows)
+
+
+def latestSeq(db_session):
+    """Returns the seq of the newest change, 0 if there is none."""
+    return db_session.query(func.max(ItemChange.seq)).scalar() or 0
+
+
+def listChanges(db_session, since, limit):
+    """Returns up to limit changes after seq since, oldest first.
+
+    Each change carries the item as it is now, or None once the item has
+    been deleted. The second value tells whether more changes follow.
+    """
+    rows = db_session.query(
+        ItemChange.seq, ItemChange.item_id, ItemChange.deleted, Item.name,
+        Item.description, Item.category_id).outerjoin(
+        Item, Item.id == ItemChange.item_id).filter(
+        ItemChange.seq > since).order_by(
+        ItemChange.seq).limit(limit + 1).all()
+
+    changes = []
+    for row in rows[:limit]:
+        # SQLite reuses the id of a deleted newest item, so a tombstone
+        # must not report the item that has its id now. A change recorded
+        # before a delete finds the item gone.
+        if row.deleted or row.name is None:
+            item = None
+        else:
+            item = {'category': row.category_id,
+                    'description': row.description,
+                    'id': row.item_id, 'name': row.name}
+        changes.append({'seq': row.seq, 'id': row.item_id,
+                        'deleted': item is None, 'Item': item})
+    return changes, len(rows) > limit
+
+
+def compactChanges(connection):
+    """Removes superseded changes; returns how many were removed."""
+    return connection.execute(COMPACT_QUERY).rowcount
+
+
+def compactIfDue(engine, seq, count=1):
+    """Compacts the log every COMPACT_EVERY changes.
+
+    Called after committing count changes, the newest of which is seq.
+    """
+    if COMPACT_EVERY > 0 and (
+            seq // COMPACT_EVERY != (seq - count) // COMPACT_EVERY):
+        with engine.begin() as connection:
+            compactChanges(connection)
+
+
+if __name__ == '__main__':
+    from db_setup import createEngine
+
+    engine = createEngine()
+
+    with engine.begin() as connection:
+        removed = compactChanges(connection)
+    print('%d superseded changes removed!' % removed)
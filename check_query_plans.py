@@ -0,0 +1,178 @@
+"""Fails if any route in main.py scans a whole table or runs extra queries.
+
+Every route is requested against a throwaway SQLite database, with the
+read cache emptied, while the SQL it issues is recorded. Each statement is
+then run through EXPLAIN QUERY PLAN, and any plan step that scans a table,
+with or without an index, is reported unless INDEX_SCAN_ALLOWED lists it:
+only SEARCH steps read a bounded part of an index. So is any route whose
+number of queries differs from EXPECTED_QUERIES, which keeps N+1 patterns
+from coming back.
+
+Usage: python check_query_plans.py
+"""
+import datetime
+import os
+import re
+import sys
+import tempfile
+
+# Tables small enough that reading them in full is expected
+FULL_SCAN_ALLOWED = {'category'}
+
+# Index scans that stop after a LIMIT of rows because nothing filters them
+INDEX_SCAN_ALLOWED = {
+    # The newest items, read from the end of the index
+    ('index', 'SCAN item USING INDEX ix_item_created_at'),
+    # The first chunk of the export, read from the start of the index
+    ('indexJSON', 'SCAN item USING INDEX ix_item_category_id'),
+    ('exportChunks', 'SCAN item USING INDEX ix_item_category_id'),
+}
+
+# Queries each route runs with an empty read cache, whatever the data size
+EXPECTED_QUERIES = {
+    # The category versions, read fresh, then the cached category list
+    'index': 3,
+    'displayCategory': 3,
+    'displayItem': 1,
+    'createNew': 1,
+    'edit': 2,
+    'delete': 1,
+    'indexJSON': 3,
+    'indexJSON_page': 3,
+    'categoryAPI': 3,
+    'categoryAPI_page': 3,
+    'itemAPI': 1,
+    # Ranking, then snippets of the best matches
+    'search': 2,
+    'searchAPI': 2,
+    'changesAPI': 1,
+    'changesAPI_head': 1,
+    'statsAPI': 2,
+    'userStatsAPI': 1,
+    'getUserID': 1,
+    # Two items one per chunk, then an empty chunk
+    'exportChunks': 3,
+}
+
+
+def findScans(connection, route, statement, parameters, tables):
+    """Returns the plan steps of a route's statement that scan a table.
+
+    Only scans of the given tables count; subqueries are always scanned.
+    """
+    plan = connection.exec_driver_sql(
+        'EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+    scans = []
+    for row in plan:
+        detail = row[-1]
+        if not detail.startswith('SCAN '):
+            continue
+        table = detail.split()[1]
+        if table not in tables or table in FULL_SCAN_ALLOWED:
+            continue
+        # A filtered scan may walk the whole index before reaching LIMIT
+        if ((route, detail) in INDEX_SCAN_ALLOWED and
+                not re.search(r'\bWHERE\b', statement)):
+            continue
+        scans.append(detail)
+    return scans
+
+
+def main():
+    workdir = tempfile.mkdtemp()
+    from sqlalchemy import event
+    import main as catalog
+    from db_setup import Base, User, Category, Item, createSchema
+
+    app = catalog.create_app({
+        'DATABASE_URL': 'sqlite:///' + os.path.join(workdir, 'catalog.db'),
+        'SECRET_KEY': 'query plan check'})
+    state = app.extensions['catalog']
+    createSchema(state.engine)
+
+    db_session = state.DBSession()
+    user = User(name='Plan Checker', email='plans@example.com')
+    category = Category(name='Action')
+    item = Item(name='Item', description='Description',
+                created_at=datetime.datetime.now(),
+                category=category, user=user)
+    db_session.add(item)
+    # A second item lets the export resume from a cursor
+    db_session.add(Item(name='Other item', description='Description',
+                        created_at=datetime.datetime.now(),
+                        category=category, user=user))
+    db_session.commit()
+    user_id, category_id, item_id = user.id, category.id, item.id
+    db_session.close()
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['username'] = 'Plan Checker'
+        session['user_id'] = user_id
+
+    cursor = catalog.encodeCursor(datetime.datetime.now(), item_id)
+    routes = [
+        ('index', '/'),
+        ('displayCategory', '/catalog/%d' % category_id),
+        ('displayItem', '/catalog/%d/%d' % (category_id, item_id)),
+        ('createNew', '/catalog/%d/new' % category_id),
+        ('edit', '/catalog/%d/edit' % item_id),
+        ('delete', '/catalog/%d/delete' % item_id),
+        ('indexJSON', '/api'),
+        ('indexJSON_page', '/api?limit=10&cursor=%s' % cursor),
+        ('categoryAPI', '/api/%d' % category_id),
+        ('categoryAPI_page',
+         '/api/%d?limit=10&cursor=%s' % (category_id, cursor)),
+        ('itemAPI', '/api/%d/%d' % (category_id, item_id)),
+        ('search', '/search?q=item'),
+        ('searchAPI', '/api/search?q=item'),
+        ('changesAPI', '/api/changes?since=0'),
+        ('changesAPI_head', '/api/changes'),
+        ('statsAPI', '/api/stats'),
+        ('userStatsAPI', '/api/stats/users/%d' % user_id),
+    ]
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            statements.append((route, statement, parameters))
+
+    event.listen(state.engine, 'before_cursor_execute', record)
+    for route, url in routes:
+        # Start cold so cached lists still issue their queries
+        state.read_cache.invalidate()
+        response = client.get(url)
+        response.get_data()
+        if response.status_code >= 400:
+            print('%s returned %d' % (url, response.status_code))
+            return 1
+    route = 'getUserID'
+    with app.app_context():
+        catalog.getUserID('plans@example.com')
+    route = 'exportChunks'
+    with app.app_context():
+        list(catalog.iterCatalogBatches(chunk_size=1))
+    event.remove(state.engine, 'before_cursor_execute', record)
+
+    failures = 0
+    for route, expected in sorted(EXPECTED_QUERIES.items()):
+        count = len([s for s in statements if s[0] == route])
+        if count != expected:
+            failures += 1
+            print('%s ran %d queries, expected %d' % (route, count, expected))
+
+    with state.engine.connect() as connection:
+        for route, statement, parameters in statements:
+            for scan in findScans(connection, route, statement, parameters,
+                                  Base.metadata.tables):
+                failures += 1
+                print('%s: %s\n    %s' % (route, scan, ' '.join(
+                    statement.split())))
+
+    print('%d queries checked, %d problems' % (len(statements), failures))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
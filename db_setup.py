@@ -1,10 +1,27 @@
-from sqlalchemy import Column, ForeignKey, Integer, String, TIMESTAMP
+import argparse
+import os
+import warnings
+from sqlalchemy import Boolean, Column, ForeignKey, Index, Integer, String
+from sqlalchemy import TIMESTAMP
 from sqlalchemy.orm import relationship
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.pool import QueuePool, StaticPool
 
 Base = declarative_base()
 
+# Database location, e.g. sqlite:///catalog.db or postgresql://...
+DATABASE_URL = os.environ.get('DATABASE_URL', 'sqlite:///catalog.db')
+
+# Connection pool settings
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 3600))
+
+# Milliseconds SQLite waits on a locked database before giving up
+SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000))
+
 
 class User(Base):
 
@@ -12,8 +29,12 @@ class User(Base):
 
     id = Column(Integer, primary_key=True)
     name = Column(String(80), nullable=False)
-    email = Column(String(250), nullable=False)
+    email = Column(String(250), nullable=False, unique=True, index=True)
     picture = Column(String())
+    # Maintained by the write paths, see stats.py
+    item_count = Column(Integer, nullable=False, default=0, server_default='0')
+    last_added_at = Column(TIMESTAMP)
+    latest_item_id = Column(Integer)
 
 
 class Category(Base):
@@ -22,6 +43,13 @@ class Category(Base):
 
     id = Column(Integer, primary_key=True)
     name = Column(String(80), nullable=False)
+    # Bumped whenever an item in the category is created, changed or deleted
+    version = Column(Integer, nullable=False, default=0, server_default='0')
+    updated_at = Column(TIMESTAMP)
+    # Maintained by the write paths, see stats.py
+    item_count = Column(Integer, nullable=False, default=0, server_default='0')
+    last_added_at = Column(TIMESTAMP)
+    latest_item_id = Column(Integer)
 
     @property
     def serialize(self):
@@ -35,16 +63,24 @@ class Category(Base):
 class Item(Base):
 
     __tablename__ = 'item'
+    __table_args__ = (
+        # Category pages and their paginated API sort by creation time
+        Index('ix_item_category_id_created_at', 'category_id', 'created_at'),
+        # Finds a user's newest item when their latest one is deleted
+        Index('ix_item_user_id_created_at', 'user_id', 'created_at'),
+    )
 
     id = Column(Integer, primary_key=True)
     name = Column(String(80), nullable=False)
     description = Column(String(250))
     picture = Column(String(250))
-    created_at = Column(TIMESTAMP, nullable=False)
+    created_at = Column(TIMESTAMP, nullable=False, index=True)
     updated_at = Column(TIMESTAMP)
-    category_id = Column(Integer, ForeignKey('category.id'), nullable=False)
+    category_id = Column(Integer, ForeignKey('category.id'), nullable=False,
+                         index=True)
     category = relationship(Category)
-    user_id = Column(Integer, ForeignKey('user.id'), nullable=False)
+    user_id = Column(Integer, ForeignKey('user.id'), nullable=False,
+                     index=True)
     user = relationship(User)
 
     @property
@@ -58,5 +94,267 @@ class Item(Base):
         }
 
 
-engine = create_engine('sqlite:///catalog.db')
-Base.metadata.create_all(engine)
+class ItemChange(Base):
+    """One write to an item, read by API clients to follow the catalog.
+
+    seq grows with every change and is never reused, even after old rows
+    are compacted away. Rows of deleted items are kept as tombstones.
+    """
+
+    __tablename__ = 'item_change'
+    __table_args__ = (
+        # Compaction finds the latest change of every item
+        Index('ix_item_change_item_id_seq', 'item_id', 'seq'),
+        {'sqlite_autoincrement': True}
+    )
+
+    seq = Column(Integer, primary_key=True)
+    # Not a foreign key: tombstones outlive their item
+    item_id = Column(Integer, nullable=False)
+    deleted = Column(Boolean, nullable=False, default=False)
+    changed_at = Column(TIMESTAMP, nullable=False)
+
+
+# Full-text indexes (SQLite FTS5) over item names and descriptions, and
+# over names alone, which search ranks first. They read their text from
+# the item table and the triggers keep them in sync on writes. Prefixes
+# of up to six letters are indexed so prefix searches can stop early.
+SEARCH_TABLES = {
+    'item_search': """CREATE VIRTUAL TABLE item_search USING fts5(
+        name, description, content='item', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3 4 5 6')""",
+    'item_name_search': """CREATE VIRTUAL TABLE item_name_search USING fts5(
+        name, content='item_name_key', content_rowid='search_key',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3 4 5 6')"""
+}
+SEARCH_TRIGGERS = ('item_search_insert', 'item_search_delete',
+                   'item_search_update', 'item_name_search_insert',
+                   'item_name_search_delete', 'item_name_search_update')
+
+# The name index is keyed by the number of words in the name, and then by
+# the item id, inverted so that newer items come first. bm25 ranks short
+# names first, so reading the index in key order ranks names without
+# scoring every match. The low NAME_KEY_ID_BITS bits hold the id.
+NAME_KEY_ID_BITS = 40
+NAME_KEY_ID_MASK = (1 << NAME_KEY_ID_BITS) - 1
+NAME_KEY = ("(min(length(%(row)sname)"
+            " - length(replace(%(row)sname, ' ', '')), 255) << {bits})"
+            " | (~%(row)sid & {mask})").format(
+                bits=NAME_KEY_ID_BITS, mask=NAME_KEY_ID_MASK)
+
+
+def nameKey(row=''):
+    """Returns the SQL computing the name index key of a row of item."""
+    return NAME_KEY % {'row': row}
+
+
+def nameKeyId(key):
+    """Returns the SQL computing the item id from a name index key."""
+    return '(~%s & %d)' % (key, NAME_KEY_ID_MASK)
+
+
+SEARCH_INDEX_DDL = [
+    SEARCH_TABLES['item_search'].replace(
+        'CREATE VIRTUAL TABLE', 'CREATE VIRTUAL TABLE IF NOT EXISTS'),
+    """CREATE TRIGGER IF NOT EXISTS item_search_insert AFTER INSERT ON item
+    BEGIN
+        INSERT INTO item_search(rowid, name, description)
+        VALUES (new.id, new.name, new.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS item_search_delete AFTER DELETE ON item
+    BEGIN
+        INSERT INTO item_search(item_search, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS item_search_update
+    AFTER UPDATE OF name, description ON item
+    BEGIN
+        INSERT INTO item_search(item_search, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+        INSERT INTO item_search(rowid, name, description)
+        VALUES (new.id, new.name, new.description);
+    END""",
+    # FTS5 looks the names up by key through this view and its index
+    'CREATE INDEX IF NOT EXISTS ix_item_name_key ON item(%s)' % nameKey(),
+    """CREATE VIEW IF NOT EXISTS item_name_key AS
+    SELECT %s AS search_key, name FROM item""" % nameKey(),
+    SEARCH_TABLES['item_name_search'].replace(
+        'CREATE VIRTUAL TABLE', 'CREATE VIRTUAL TABLE IF NOT EXISTS'),
+    """CREATE TRIGGER IF NOT EXISTS item_name_search_insert
+    AFTER INSERT ON item
+    BEGIN
+        INSERT INTO item_name_search(rowid, name)
+        VALUES (%s, new.name);
+    END""" % nameKey('new.'),
+    """CREATE TRIGGER IF NOT EXISTS item_name_search_delete
+    AFTER DELETE ON item
+    BEGIN
+        INSERT INTO item_name_search(item_name_search, rowid, name)
+        VALUES ('delete', %s, old.name);
+    END""" % nameKey('old.'),
+    """CREATE TRIGGER IF NOT EXISTS item_name_search_update
+    AFTER UPDATE OF name ON item
+    BEGIN
+        INSERT INTO item_name_search(item_name_search, rowid, name)
+        VALUES ('delete', %s, old.name);
+        INSERT INTO item_name_search(rowid, name)
+        VALUES (%s, new.name);
+    END""" % (nameKey('old.'), nameKey('new.'))
+]
+
+
+def createSearchIndex(connection):
+    """Creates the full-text indexes and their triggers if they are missing."""
+    for statement in SEARCH_INDEX_DDL:
+        connection.exec_driver_sql(statement)
+
+
+def outdatedSearchIndexes(connection):
+    """Drops full-text indexes defined differently by an older version.
+
+    Returns the names of the indexes that are missing now.
+    """
+    defined = dict((row.name, row.sql) for row in connection.exec_driver_sql(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'table'"))
+    missing = []
+    for table, statement in SEARCH_TABLES.items():
+        if defined.get(table) != statement:
+            connection.exec_driver_sql('DROP TABLE IF EXISTS %s' % table)
+            missing.append(table)
+    return missing
+
+
+def rebuildSearchIndex(connection, tables=tuple(SEARCH_TABLES)):
+    """Re-reads every item into the given full-text indexes."""
+    for table in tables:
+        connection.exec_driver_sql(
+            "INSERT INTO %s(%s) VALUES ('rebuild')" % (table, table))
+
+
+def dropSearchTriggers(connection):
+    """Stops syncing the full-text indexes, e.g. during a bulk load."""
+    for trigger in SEARCH_TRIGGERS:
+        connection.exec_driver_sql('DROP TRIGGER IF EXISTS %s' % trigger)
+
+
+@event.listens_for(Item.__table__, 'after_create')
+def itemTableCreated(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        createSearchIndex(connection)
+
+
+def setSQLitePragmas(dbapi_connection, connection_record):
+    """Tunes every new SQLite connection for concurrent readers."""
+    cursor = dbapi_connection.cursor()
+    # WAL lets readers run while a writer holds the lock
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA busy_timeout=%d' % SQLITE_BUSY_TIMEOUT)
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+
+def createEngine(url=DATABASE_URL, pool_size=POOL_SIZE,
+                 max_overflow=MAX_OVERFLOW, pool_timeout=POOL_TIMEOUT,
+                 pool_recycle=POOL_RECYCLE):
+    """Creates an engine; pool settings default to the configured ones.
+
+    Nothing connects until the engine is first used.
+    """
+    if url in ('sqlite://', 'sqlite:///:memory:'):
+        # An in-memory database only exists on its single connection
+        return create_engine(
+            url, poolclass=StaticPool,
+            connect_args={'check_same_thread': False})
+    options = {
+        'poolclass': QueuePool,
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        'pool_timeout': pool_timeout,
+        'pool_recycle': pool_recycle
+    }
+    sqlite = url.startswith('sqlite')
+    if sqlite:
+        # Pooled connections are handed to whichever thread needs one
+        options['connect_args'] = {'check_same_thread': False}
+    engine = create_engine(url, **options)
+    if sqlite:
+        event.listen(engine, 'connect', setSQLitePragmas)
+    return engine
+
+
+def addMissingColumns(engine):
+    """Adds columns missing from a database created by an older version.
+
+    Returns the names of the added columns as table.column.
+    """
+    added = []
+    inspector = inspect(engine)
+    preparer = engine.dialect.identifier_preparer
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            existing = set(
+                c['name'] for c in inspector.get_columns(table.name))
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                statement = 'ALTER TABLE %s ADD COLUMN %s %s' % (
+                    preparer.format_table(table),
+                    preparer.format_column(column),
+                    column.type.compile(engine.dialect))
+                if column.server_default is not None:
+                    statement += " DEFAULT '%s'" % column.server_default.arg
+                if not column.nullable:
+                    statement += ' NOT NULL'
+                connection.exec_driver_sql(statement)
+                added.append('%s.%s' % (table.name, column.name))
+    return added
+
+
+def createIndexes(engine):
+    """Adds indexes missing from a database created by an older version."""
+    with warnings.catch_warnings():
+        # Checking for an index reads them all, and SQLAlchemy cannot read
+        # the expression index of the name search
+        warnings.filterwarnings(
+            'ignore', 'Skipped unsupported reflection of expression-based')
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=engine, checkfirst=True)
+    if engine.dialect.name == 'sqlite':
+        with engine.begin() as connection:
+            # Indexes new to the database, or defined differently by an
+            # older version, need filling once
+            missing = outdatedSearchIndexes(connection)
+            createSearchIndex(connection)
+            if missing:
+                rebuildSearchIndex(connection, missing)
+            # Refresh the statistics the query planner uses to pick indexes
+            connection.exec_driver_sql('ANALYZE')
+
+
+def createSchema(engine):
+    """Creates missing tables, columns and indexes.
+
+    Returns the names of the columns added to existing tables.
+    """
+    Base.metadata.create_all(engine)
+    # create_all skips existing tables, so add their new columns and indexes
+    added = addMissingColumns(engine)
+    createIndexes(engine)
+    return added
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(
+        description='Creates or upgrades the catalog database.')
+    parser.add_argument('--database-url', default=DATABASE_URL,
+                        help='database to set up (default %(default)s)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parseArgs()
+    added = createSchema(createEngine(args.database_url))
+    print('database is up to date!')
+    if 'category.item_count' in added or 'user.item_count' in added:
+        print('run "python stats.py" to fill in the new item counts')
@@ -0,0 +1,11 @@
+"""File helpers shared by the picture store and the asset build."""
+import os
+
+
+def writeFile(path, data):
+    """Writes data to path atomically, so readers never see part of it."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
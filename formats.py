@@ -0,0 +1,126 @@
+"""Body formats and compression for the JSON API.
+
+Clients choose the format with the Accept header: JSON by default, or
+MessagePack (application/msgpack) when the msgpack package is installed.
+JSON is encoded with orjson when it is installed and with the standard
+library otherwise. Either way the bytes are those jsonify writes:
+compact, with sorted keys and every non-ASCII character escaped.
+
+Bodies of at least COMPRESS_MIN_SIZE bytes, and every streamed body, are
+compressed with brotli (when installed) or gzip, whichever the client's
+Accept-Encoding header prefers.
+"""
+import json
+import os
+import zlib
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+
+# Smaller bodies are sent as they are; compressing them gains little
+COMPRESS_MIN_SIZE = int(os.environ.get('API_COMPRESS_MIN_SIZE', 1024))
+# Bodies are compressed on every request, so favour speed over size
+GZIP_LEVEL = int(os.environ.get('API_GZIP_LEVEL', 4))
+BROTLI_QUALITY = int(os.environ.get('API_BROTLI_QUALITY', 5))
+
+# Media types clients may ask for, mapped to the one that is served
+MEDIA_TYPES = {JSON: JSON}
+if msgpack is not None:
+    MEDIA_TYPES[MSGPACK] = MSGPACK
+    MEDIA_TYPES['application/x-msgpack'] = MSGPACK
+
+CONTENT_CODINGS = ['br', 'gzip'] if brotli is not None else ['gzip']
+
+
+def negotiateFormat(accept_mimetypes):
+    """Returns the media type to answer with, JSON unless asked otherwise."""
+    match = accept_mimetypes.best_match(list(MEDIA_TYPES), default=JSON)
+    return MEDIA_TYPES[match]
+
+
+def negotiateEncoding(accept_encodings):
+    """Returns 'br', 'gzip' or None for an uncompressed body."""
+    return accept_encodings.best_match(CONTENT_CODINGS)
+
+
+def encodeStdlibJSON(obj):
+    return json.dumps(
+        obj, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+if orjson is not None:
+    def encodeJSON(obj):
+        body = orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+        # orjson writes UTF-8 and DEL as they are, where jsonify escapes
+        # them. Those bodies are left to the standard library.
+        if body.isascii() and b'\x7f' not in body:
+            return body
+        return encodeStdlibJSON(obj)
+else:
+    encodeJSON = encodeStdlibJSON
+
+
+def encode(obj, mimetype, encoder=encodeJSON):
+    """Returns obj as a complete response body of the given media type.
+
+    JSON is encoded with encoder, which defaults to encodeJSON.
+    """
+    if mimetype == MSGPACK:
+        return msgpack.packb(obj, use_bin_type=True)
+    # jsonify ends its output with a newline too
+    return encoder(obj) + b'\n'
+
+
+def compressBody(body, coding):
+    if coding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    return compressor.compress(body) + compressor.flush()
+
+
+def compressStream(chunks, coding):
+    """Compresses a streamed body as it is generated."""
+    if coding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        compress, finish = compressor.process, compressor.finish
+    else:
+        # wbits 31 writes a gzip header and trailer
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        compress, finish = compressor.compress, compressor.flush
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        data = compress(chunk)
+        if data:
+            yield data
+    yield finish()
+
+
+def compressResponse(response, coding):
+    """Compresses a response's body with coding, if it is worth it."""
+    if coding is None or 'Content-Encoding' in response.headers:
+        return response
+    if response.is_streamed:
+        response.response = compressStream(response.response, coding)
+    else:
+        body = response.get_data()
+        if len(body) < COMPRESS_MIN_SIZE:
+            return response
+        response.set_data(compressBody(body, coding))
+    response.headers['Content-Encoding'] = coding
+    return response
@@ -0,0 +1,158 @@
+"""Item picture uploads and their thumbnails.
+
+Uploads are stored under the SHA-256 of their content, so the same image
+uploaded twice is kept once and a stored file never changes. That lets
+every file be served with an immutable, year-long cache lifetime.
+
+Checking an upload only reads the image header. Decoding and resizing it
+into THUMBNAIL_WIDTHS wide WebP and JPEG files happens in a process pool
+after the request has returned. Until a thumbnail exists its URL serves
+a placeholder that browsers revalidate.
+"""
+import hashlib
+import io
+import logging
+import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageOps
+
+from files import writeFile
+
+logger = logging.getLogger('catalog.images')
+
+UPLOAD_DIR = os.environ.get('CATALOG_UPLOAD_DIR', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'uploads'))
+
+# Largest upload accepted, in bytes and in pixels
+MAX_UPLOAD_BYTES = int(os.environ.get('CATALOG_MAX_UPLOAD_BYTES',
+                                      8 * 1024 * 1024))
+MAX_PIXELS = 40 * 1000 * 1000
+
+# Processes generating thumbnails
+THUMBNAIL_WORKERS = int(os.environ.get('CATALOG_THUMBNAIL_WORKERS', 2))
+
+# Lists show 96px thumbnails (192px on high density screens), item pages
+# 480px ones
+THUMBNAIL_WIDTHS = (96, 192, 480)
+
+# Upload formats accepted, with the extension they are stored under
+FORMATS = {'JPEG': 'jpg', 'PNG': 'png', 'GIF': 'gif', 'WEBP': 'webp'}
+
+# Names of stored files: originals and <digest>-<width> thumbnails
+NAME_PATTERN = re.compile(
+    r'^([0-9a-f]{64})(?:-([0-9]+))?\.(jpg|png|gif|webp)$')
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class InvalidImage(ValueError):
+    pass
+
+
+def filePath(name):
+    """Returns where a stored file lives, spread over 256 directories."""
+    return os.path.join(UPLOAD_DIR, name[:2], name)
+
+
+def thumbnailName(picture, width, extension):
+    """Returns the file name of a picture's thumbnail."""
+    return '%s-%d.%s' % (picture.split('.')[0], width, extension)
+
+
+def saveUpload(upload):
+    """Stores an uploaded image and queues its thumbnails.
+
+    Returns the stored name to keep in Item.picture, or None if nothing
+    was uploaded. Raises InvalidImage for anything that isn't a JPEG,
+    PNG, GIF or WebP image within the size limits.
+    """
+    if upload is None or not upload.filename:
+        return None
+    data = upload.stream.read(MAX_UPLOAD_BYTES + 1)
+    if len(data) > MAX_UPLOAD_BYTES:
+        raise InvalidImage('Pictures can be at most %d MB.'
+                           % (MAX_UPLOAD_BYTES // (1024 * 1024)))
+    try:
+        # Only reads the header; the pixels are decoded by the workers
+        image = Image.open(io.BytesIO(data))
+    except Exception:
+        raise InvalidImage('Pictures must be JPEG, PNG, GIF or WebP images.')
+    extension = FORMATS.get(image.format)
+    if extension is None:
+        raise InvalidImage('Pictures must be JPEG, PNG, GIF or WebP images.')
+    if image.width * image.height > MAX_PIXELS:
+        raise InvalidImage('Pictures can be at most %d megapixels.'
+                           % (MAX_PIXELS // 1000000))
+
+    name = '%s.%s' % (hashlib.sha256(data).hexdigest(), extension)
+    path = filePath(name)
+    if not os.path.exists(path):
+        writeFile(path, data)
+    if not os.path.exists(filePath(thumbnailName(
+            name, THUMBNAIL_WIDTHS[-1], 'jpg'))):
+        queueThumbnails(name)
+    return name
+
+
+def thumbnailPool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=THUMBNAIL_WORKERS)
+    return _pool
+
+
+def queueThumbnails(name):
+    """Generates a picture's thumbnails in the background."""
+    future = thumbnailPool().submit(makeThumbnails, UPLOAD_DIR, name)
+
+    def logFailure(future):
+        if future.exception() is not None:
+            logger.error('thumbnails of %s failed: %r', name,
+                         future.exception())
+
+    future.add_done_callback(logFailure)
+
+
+def makeThumbnails(upload_dir, name):
+    """Writes every thumbnail of a stored picture. Runs in a worker."""
+    digest = name.split('.')[0]
+    directory = os.path.join(upload_dir, name[:2])
+    with Image.open(os.path.join(directory, name)) as image:
+        # Turn photos the way the camera held them
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA')
+        # JPEG has no transparency, so put the image on white
+        opaque = Image.new('RGB', image.size, (255, 255, 255))
+        opaque.paste(image, mask=image if image.mode == 'RGBA' else None)
+
+        # Largest last, so a missing 480px JPEG means "not done yet"
+        for width in sorted(THUMBNAIL_WIDTHS):
+            for source, extension, options in (
+                    (image, 'webp', {'quality': 80, 'method': 4}),
+                    (opaque, 'jpg', {'quality': 82, 'optimize': True,
+                                     'progressive': True})):
+                thumbnail = source.copy()
+                # Keeps the aspect ratio and never enlarges
+                thumbnail.thumbnail((width, width * 4), Image.LANCZOS)
+                output = io.BytesIO()
+                thumbnail.save(output, 'JPEG' if extension == 'jpg'
+                               else 'WEBP', **options)
+                writeFile(os.path.join(directory, '%s-%d.%s' % (
+                    digest, width, extension)), output.getvalue())
+
+
+def storedFile(name):
+    """Returns (path, is_thumbnail) for a stored file name, or None.
+
+    The path may not exist yet if it belongs to a pending thumbnail.
+    """
+    match = NAME_PATTERN.match(name)
+    if match is None:
+        return None
+    return filePath(name), match.group(2) is not None
@@ -0,0 +1,264 @@
+"""Opt-in per-request SQL and timing instrumentation.
+
+Once attached to an app, every request records its SQL query count, total
+database time, slowest statements, template render time and JSON
+serialization time. Each request's numbers are sent as a Server-Timing
+header and logged as one JSON line on the catalog.requests logger. They
+are also added to totals served at /metrics in the Prometheus text format.
+
+Nothing is hooked up unless an Instrumentation is created, so the app pays
+no cost when it is disabled.
+"""
+import json
+import logging
+import threading
+import time
+
+from flask import Response, has_request_context, request
+from flask import before_render_template, request_started, template_rendered
+from sqlalchemy import event
+
+logger = logging.getLogger('catalog.requests')
+
+# Upper bounds in seconds of the request duration histogram buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# Number of slowest statements kept per request
+SLOW_QUERY_COUNT = 3
+
+
+class RequestTimings(object):
+    """Timings collected while one request is handled."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.serialize_time = 0.0
+        self.slow_queries = []
+        self.template_started = None
+        self.method = None
+        self.path = None
+        self.endpoint = None
+        self.status = None
+        self.streamed = False
+
+    def addQuery(self, statement, elapsed):
+        self.queries += 1
+        self.db_time += elapsed
+        self.slow_queries.append((elapsed, statement))
+        self.slow_queries.sort(key=lambda q: q[0], reverse=True)
+        del self.slow_queries[SLOW_QUERY_COUNT:]
+
+
+class EndpointTotals(object):
+    """Aggregated timings of all requests to one endpoint."""
+
+    def __init__(self):
+        self.statuses = {}
+        self.buckets = [0] * len(DURATION_BUCKETS)
+        self.count = 0
+        self.duration = 0.0
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.serialize_time = 0.0
+
+
+def currentTimings():
+    """Returns the timings of the request being handled, if any.
+
+    They are kept in the WSGI environ rather than on g because a streamed
+    body is generated in a fresh app context.
+    """
+    if not has_request_context():
+        return None
+    return request.environ.get('catalog.request_timings')
+
+
+def timedSerialization(dumps):
+    """Wraps an encoder to add its run time to the request's timings."""
+    def timedDumps(obj, **kwargs):
+        started = time.perf_counter()
+        try:
+            return dumps(obj, **kwargs)
+        finally:
+            timings = currentTimings()
+            if timings is not None:
+                timings.serialize_time += time.perf_counter() - started
+    return timedDumps
+
+
+class Instrumentation(object):
+    """Hooks request, template, JSON and SQL timing into a Flask app."""
+
+    def __init__(self, app, engine):
+        self._totals = {}
+        self._lock = threading.Lock()
+
+        event.listen(engine, 'before_cursor_execute', self.beforeQuery)
+        event.listen(engine, 'after_cursor_execute', self.afterQuery)
+        request_started.connect(self.requestStarted, app, weak=False)
+        before_render_template.connect(self.beforeTemplate, app, weak=False)
+        template_rendered.connect(self.templateRendered, app, weak=False)
+        app.after_request(self.addServerTiming)
+        app.teardown_request(self.requestFinished)
+        app.add_url_rule('/metrics', 'metrics', self.metrics)
+
+        # jsonify encodes through the app's JSON provider and the API
+        # through the encodeJSON of its CatalogState
+        app.json.dumps = timedSerialization(app.json.dumps)
+        state = app.extensions['catalog']
+        state.encodeJSON = timedSerialization(state.encodeJSON)
+
+    # SQLAlchemy events
+
+    def beforeQuery(self, conn, cursor, statement, parameters, context,
+                    executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    def afterQuery(self, conn, cursor, statement, parameters, context,
+                   executemany):
+        elapsed = time.perf_counter() - conn.info['query_started'].pop()
+        timings = currentTimings()
+        if timings is not None:
+            timings.addQuery(statement, elapsed)
+
+    # Flask signals
+
+    def requestStarted(self, sender, **extra):
+        timings = RequestTimings()
+        timings.method = request.method
+        timings.path = request.path
+        request.environ['catalog.request_timings'] = timings
+
+    def beforeTemplate(self, sender, template, context, **extra):
+        timings = currentTimings()
+        if timings is not None:
+            timings.template_started = time.perf_counter()
+
+    def templateRendered(self, sender, template, context, **extra):
+        timings = currentTimings()
+        if timings is not None and timings.template_started is not None:
+            timings.template_time += (
+                time.perf_counter() - timings.template_started)
+            timings.template_started = None
+
+    def addServerTiming(self, response):
+        """Reports the timings so far in a Server-Timing header."""
+        timings = currentTimings()
+        if timings is None:
+            return response
+        total = time.perf_counter() - timings.started
+        response.headers['Server-Timing'] = ', '.join([
+            'db;dur=%.2f;desc="%d queries"' % (
+                timings.db_time * 1000, timings.queries),
+            'tpl;dur=%.2f' % (timings.template_time * 1000),
+            'ser;dur=%.2f' % (timings.serialize_time * 1000),
+            'total;dur=%.2f' % (total * 1000)
+        ])
+        timings.status = response.status_code
+        timings.endpoint = request.endpoint
+        if response.is_streamed:
+            # Finish once the body has been sent, counting its queries too
+            timings.streamed = True
+            response.call_on_close(lambda: self.finish(timings))
+        return response
+
+    def requestFinished(self, exception=None):
+        timings = currentTimings()
+        if timings is None or timings.streamed:
+            return
+        self.finish(timings)
+
+    def finish(self, timings):
+        """Logs a finished request and adds it to the totals."""
+        duration = time.perf_counter() - timings.started
+        # No status means the response was never built
+        status = timings.status or 500
+        endpoint = timings.endpoint or 'unknown'
+
+        logger.info(json.dumps({
+            'method': timings.method,
+            'path': timings.path,
+            'endpoint': endpoint,
+            'status': status,
+            'duration_ms': round(duration * 1000, 2),
+            'db_queries': timings.queries,
+            'db_ms': round(timings.db_time * 1000, 2),
+            'template_ms': round(timings.template_time * 1000, 2),
+            'serialize_ms': round(timings.serialize_time * 1000, 2),
+            'slow_queries': [
+                {'ms': round(elapsed * 1000, 2),
+                 'statement': ' '.join(statement.split())[:300]}
+                for elapsed, statement in timings.slow_queries]
+        }))
+
+        with self._lock:
+            totals = self._totals.get(endpoint)
+            if totals is None:
+                totals = self._totals[endpoint] = EndpointTotals()
+            totals.statuses[status] = totals.statuses.get(status, 0) + 1
+            for n, bound in enumerate(DURATION_BUCKETS):
+                if duration <= bound:
+                    totals.buckets[n] += 1
+            totals.count += 1
+            totals.duration += duration
+            totals.queries += timings.queries
+            totals.db_time += timings.db_time
+            totals.template_time += timings.template_time
+            totals.serialize_time += timings.serialize_time
+
+    # /metrics
+
+    def metrics(self):
+        """Serves the totals in the Prometheus text exposition format."""
+        with self._lock:
+            totals = sorted(self._totals.items())
+            lines = [
+                '# HELP catalog_requests_total Requests handled.',
+                '# TYPE catalog_requests_total counter']
+            for endpoint, t in totals:
+                for status, count in sorted(t.statuses.items()):
+                    lines.append(
+                        'catalog_requests_total{endpoint="%s",status="%d"} %d'
+                        % (endpoint, status, count))
+
+            lines += [
+                '# HELP catalog_request_duration_seconds Request duration.',
+                '# TYPE catalog_request_duration_seconds histogram']
+            for endpoint, t in totals:
+                for bound, count in zip(DURATION_BUCKETS, t.buckets):
+                    lines.append(
+                        'catalog_request_duration_seconds_bucket'
+                        '{endpoint="%s",le="%s"} %d'
+                        % (endpoint, bound, count))
+                lines.append(
+                    'catalog_request_duration_seconds_bucket'
+                    '{endpoint="%s",le="+Inf"} %d' % (endpoint, t.count))
+                lines.append(
+                    'catalog_request_duration_seconds_sum{endpoint="%s"} %f'
+                    % (endpoint, t.duration))
+                lines.append(
+                    'catalog_request_duration_seconds_count{endpoint="%s"} %d'
+                    % (endpoint, t.count))
+
+            counters = [
+                ('catalog_db_queries_total', 'SQL statements executed.',
+                 'queries', '%d'),
+                ('catalog_db_duration_seconds_total',
+                 'Time spent executing SQL.', 'db_time', '%f'),
+                ('catalog_template_duration_seconds_total',
+                 'Time spent rendering templates.', 'template_time', '%f'),
+                ('catalog_serialize_duration_seconds_total',
+                 'Time spent encoding JSON.', 'serialize_time', '%f')]
+            for name, help_text, attribute, value_format in counters:
+                lines += ['# HELP %s %s' % (name, help_text),
+                          '# TYPE %s counter' % name]
+                for endpoint, t in totals:
+                    lines.append(('%s{endpoint="%s"} ' + value_format) % (
+                        name, endpoint, getattr(t, attribute)))
+
+        return Response('\n'.join(lines) + '\n',
+                        mimetype='text/plain; version=0.0.4')
@@ -1,61 +1,191 @@
+"""The anime catalog web app.
+
+create_app() builds an app from environment variables and an optional
+config mapping; the routes live on the catalog blueprint. Importing this
+module connects to nothing, so workers, scripts and tests only pay for
+the database and the login client libraries once they use them.
+"""
 import os
-import httplib2
-import json
+import base64
+import mimetypes
+import hashlib
 import datetime
 from functools import wraps
-from flask import Flask, session, redirect, render_template, request, url_for
-from flask import flash, jsonify, make_response
+from itertools import groupby
+from operator import attrgetter
+from flask import Blueprint, Flask, current_app
+from flask import session, redirect, render_template, request, url_for
+from flask import abort
+from flask import flash, jsonify, make_response, Response, stream_with_context
+from flask import send_file, send_from_directory
 from flask_seasurf import SeaSurf
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import tuple_
+from sqlalchemy.orm import joinedload, scoped_session, sessionmaker
+from werkzeug.local import LocalProxy
+
+from db_setup import User, Category, Item, createEngine
+import db_setup
+from cache import ReadCache
+from page_cache import createPageCache
+from instrumentation import Instrumentation
+from search import searchItems, SEARCH_LIMIT, SEARCH_MAX_LIMIT
+import assets
+import batch
+import changes
+import stats
+import formats
+import images
+import oauth
+
+
+def defaultConfig():
+    """Returns the settings create_app() reads from environment variables."""
+    return {
+        'DATABASE_URL': db_setup.DATABASE_URL,
+        'DB_POOL_SIZE': db_setup.POOL_SIZE,
+        'DB_MAX_OVERFLOW': db_setup.MAX_OVERFLOW,
+        'DB_POOL_TIMEOUT': db_setup.POOL_TIMEOUT,
+        'DB_POOL_RECYCLE': db_setup.POOL_RECYCLE,
+        'CATALOG_CACHE_SIZE': int(os.environ.get('CATALOG_CACHE_SIZE', 256)),
+        'CATALOG_CACHE_TTL': float(os.environ.get('CATALOG_CACHE_TTL', 60)),
+        'CATALOG_PAGE_CACHE': os.environ.get('CATALOG_PAGE_CACHE', 'memory'),
+        'CATALOG_PAGE_CACHE_BYTES': int(os.environ.get(
+            'CATALOG_PAGE_CACHE_BYTES', 32 << 20)),
+        'CATALOG_INSTRUMENTATION': bool(
+            os.environ.get('CATALOG_INSTRUMENTATION')),
+        'SECRET_KEY': os.environ.get('CATALOG_SECRET_KEY'),
+        'TRAP_HTTP_EXCEPTIONS': True,
+        # Let a front-end server such as nginx send uploaded files
+        'USE_X_SENDFILE': bool(os.environ.get('CATALOG_X_SENDFILE'))
+    }
+
+
+class CatalogState(object):
+    """The database and caches of one app made by create_app()."""
+
+    def __init__(self, config):
+        # Connects lazily, on the first query
+        self.engine = createEngine(
+            config['DATABASE_URL'], pool_size=config['DB_POOL_SIZE'],
+            max_overflow=config['DB_MAX_OVERFLOW'],
+            pool_timeout=config['DB_POOL_TIMEOUT'],
+            pool_recycle=config['DB_POOL_RECYCLE'])
+        # Objects stay loaded after commit so redirects don't reload them
+        self.DBSession = sessionmaker(bind=self.engine,
+                                      expire_on_commit=False)
+        # Reads that rarely change; every write path invalidates them
+        self.read_cache = ReadCache(max_entries=config['CATALOG_CACHE_SIZE'],
+                                    ttl=config['CATALOG_CACHE_TTL'])
+        # Pages rendered for anonymous visitors, keyed on what they show
+        self.page_cache = createPageCache(
+            config['CATALOG_PAGE_CACHE'],
+            max_bytes=config['CATALOG_PAGE_CACHE_BYTES'])
+        # Fingerprinted static files written by assets.py, or None
+        self.asset_manifest = assets.loadManifest()
+        # Encodes the API's JSON; Instrumentation replaces it to time it
+        self.encodeJSON = formats.encodeJSON
+
+
+def appState():
+    """Returns the CatalogState of the app handling the current request."""
+    return current_app.extensions['catalog']
+
+
+# The current app's engine and read cache
+engine = LocalProxy(lambda: appState().engine)
+read_cache = LocalProxy(lambda: appState().read_cache)
+
+# A database session per thread on the current app's database, removed
+# when each request ends
+db_session = scoped_session(lambda: appState().DBSession())
+
+catalog = Blueprint('catalog', __name__)
+csrf = SeaSurf()
+
+
+def create_app(config=None):
+    """Creates the catalog app.
+
+    config overrides the settings read from environment variables, e.g.
+    {'DATABASE_URL': 'sqlite:///test.db'}. The database must already
+    have its tables; db_setup.py creates them.
+    """
+    app = Flask(__name__)
+    app.config.from_mapping(defaultConfig())
+    app.config.from_mapping(config or {})
+    state = app.extensions['catalog'] = CatalogState(app.config)
+    csrf.init_app(app)
+    app.register_blueprint(catalog)
+    app.teardown_appcontext(removeSession)
+    # Opt-in per-request SQL and timing instrumentation, served at /metrics
+    if app.config['CATALOG_INSTRUMENTATION']:
+        Instrumentation(app, state.engine)
+    return app
+
+
+def removeSession(exception=None):
+    db_session.remove()
+
+
+catalog.add_app_template_global(images.thumbnailName, 'thumbnailName')
+
 
-from db_setup import Base, User, Category, Item
-from oauth2client import client
-from apiclient import discovery
+@catalog.app_template_global()
+def staticURL(filename):
+    """Returns the URL of a static file's fingerprinted copy if it has one.
 
+    In debug mode files are linked directly, so edits show without a build.
+    """
+    asset_manifest = appState().asset_manifest
+    if asset_manifest is not None and not current_app.debug:
+        entry = asset_manifest['files'].get(filename)
+        if entry is not None:
+            return url_for('catalog.asset', name=entry['path'])
+    return url_for('static', filename=filename)
 
-app = Flask(__name__)
-csrf = SeaSurf(app)
-app.config['TRAP_HTTP_EXCEPTIONS'] = True
 
-# Connect to database
-engine = create_engine('sqlite:///catalog.db')
-Base.metadata.bind = engine
+@csrf.disable_cookie
+def fileWithoutToken(response):
+    # Shared caches don't store responses that set a cookie
+    return request.endpoint in ('catalog.asset', 'catalog.image', 'static')
 
-# Create database session
-DBSession = sessionmaker(bind=engine)
-db_session = DBSession()
 
 # Custom error handlers
 
 
-@app.errorhandler(404)
+@catalog.app_errorhandler(404)
 def pageNotFound(Exception):
     return render_template('error404.html'), 404
 
 
-@app.errorhandler(500)
+# SeaSurf rejects writes without a valid CSRF token with a 403. API
+# clients get the reason as JSON, browsers a page.
+@catalog.app_errorhandler(403)
+def forbidden(error):
+    if request.is_json or request.path.startswith('/api/'):
+        return jsonify(error=error.description), 403
+    return render_template('error403.html'), 403
+
+
+@catalog.app_errorhandler(500)
 def pageNotFound(Exception):
     return render_template('error500.html'), 500
 
 # Login/authorize routes and functions
 
 
-@app.route('/glogin')
+@catalog.route('/glogin')
 def googleLogin():
     """Handles Google login."""
 
     if 'credentials' not in session:
-        return redirect(url_for('goauth2redirect'))
+        return redirect(url_for('catalog.goauth2redirect'))
 
-    credentials = client.OAuth2Credentials.from_json(session['credentials'])
+    credentials = oauth.loadCredentials(session['credentials'])
     if credentials.access_token_expired:
-        return redirect(url_for('goauth2redirect'))
+        return redirect(url_for('catalog.goauth2redirect'))
     else:
-        http_auth = credentials.authorize(httplib2.Http())
-        service = discovery.build('oauth2', 'v2', http=http_auth)
-        request = service.userinfo().v2().me().get()
-        response = request.execute()
+        response = oauth.fetchUserInfo(credentials)
         # print(response)
         # All this data comes in the profile scope
         session['provider'] = 'google'
@@ -70,19 +200,15 @@ def googleLogin():
             user_id = createUser(session)
         session['user_id'] = user_id
 
-    return redirect(url_for('index'))
+    return redirect(url_for('catalog.index'))
 
 
-@app.route('/goauth2redirect')
+@catalog.route('/goauth2redirect')
 def goauth2redirect():
     """Handles Google authentication"""
 
     # Build a flow object
-    flow = client.flow_from_clientsecrets(
-          'client_secrets.json',
-          scope=['https://www.googleapis.com/auth/userinfo.profile',
-                 'https://www.googleapis.com/auth/userinfo.email'],
-          redirect_uri=url_for('goauth2redirect', _external=True))
+    flow = oauth.buildFlow(url_for('catalog.goauth2redirect', _external=True))
     if 'code' not in request.args:
         # Get authorization code
         auth_uri = flow.step1_get_authorize_url()
@@ -90,9 +216,9 @@ def goauth2redirect():
     else:
         # Upgrade authorization code for credentials
         auth_code = request.args.get('code')
-        credentials = flow.step2_exchange(auth_code)
+        credentials = oauth.exchangeCode(flow, auth_code)
         session['credentials'] = credentials.to_json()
-        return redirect(url_for('googleLogin'))
+        return redirect(url_for('catalog.googleLogin'))
 
 
 # User helper functions
@@ -106,36 +232,207 @@ def createUser(session):
     db_session.add(newUser)
     db_session.flush()
     db_session.commit()
+    read_cache.invalidate()
     return newUser.id
 
 
 def getUserID(email):
-    """Retrieves a user record"""
-    try:
-        user = db_session.query(User).filter_by(email=email).one()
-        return user.id
-    except:
-        return None
+    """Retrieves a user's id, cached once the user exists"""
+    key = ('user_id', email)
+    user_id = read_cache.get(key, lambda: lookupUserID(email))
+    if user_id is None:
+        # Don't remember misses; another worker may create the user
+        read_cache.discard(key)
+    return user_id
+
+
+def lookupUserID(email):
+    row = db_session.query(User.id).filter(User.email == email).first()
+    return row.id if row else None
 
 
 # Logout routes
 
-@app.route('/logout')
+@catalog.route('/logout')
 def logout():
     session.clear()
-    return redirect(url_for('index'))
+    return redirect(url_for('catalog.index'))
 
 
-@app.route('/disconnect')
+@catalog.route('/disconnect')
 def disconnect():
     if session['provider'] == 'google':
         glogout()
-    return redirect(url_for('logout'))
+    return redirect(url_for('catalog.logout'))
 
 
 def glogout():
-    credentials = client.OAuth2Credentials.from_json(session['credentials'])
-    credentials.revoke(httplib2.Http())
+    oauth.revoke(oauth.loadCredentials(session['credentials']))
+
+# Cached read helpers
+
+
+def getCategories():
+    """Returns the rows of all categories, with their item statistics."""
+    return read_cache.get('categories', lambda: db_session.query(
+        Category.id, Category.name, Category.version, Category.updated_at,
+        Category.item_count, Category.last_added_at,
+        Category.latest_item_id).order_by(Category.id).all())
+
+
+def currentCategories():
+    """Returns getCategories(), reloaded if another worker has written.
+
+    The read cache belongs to this process, so on its own it only sees
+    other workers' writes once its TTL expires. Every item write bumps a
+    category version, so the versions are read fresh and any difference
+    drops the whole read cache before anything is rendered from it.
+    """
+    versions = db_session.query(Category.id, Category.version).order_by(
+        Category.id).all()
+    categories = getCategories()
+    cached = [(c.id, c.version) for c in categories]
+    if cached != [tuple(v) for v in versions]:
+        read_cache.invalidate()
+        categories = getCategories()
+    return categories
+
+
+def getLatestItems():
+    """Returns the ten most recently created items with their category."""
+    return read_cache.get('latest', lambda: db_session.query(
+        Item.id, Item.name, Item.category_id, Item.picture,
+        Category.name.label('category_name')).join(
+        Category, Item.category_id == Category.id).order_by(
+        Item.created_at.desc()).limit(10).all())
+
+
+def getCategoryItems(category_id):
+    """Returns (id, name, picture) rows for the items in a category."""
+    key = ('category_items', category_id)
+    return read_cache.get(key, lambda: db_session.query(
+        Item.id, Item.name, Item.picture).filter(
+        Item.category_id == category_id).all())
+
+
+def loadItem(item_id):
+    """Loads an item and its category in a single query, or aborts 404."""
+    item = db_session.query(Item).options(joinedload(Item.category)).filter(
+        Item.id == item_id).first()
+    if item is None:
+        abort(404)
+    return item
+
+
+# Conditional request helpers
+
+
+def touchCategories(*category_ids):
+    """Bumps the version of categories whose items are being written.
+
+    Runs inside the caller's transaction, so the new version is committed
+    together with the item change.
+    """
+    db_session.query(Category).filter(
+        Category.id.in_(set(int(c) for c in category_ids))).update({
+            Category.version: Category.version + 1,
+            Category.updated_at: datetime.datetime.now()
+        }, synchronize_session=False)
+
+
+def findCategory(categories, category_id):
+    """Returns the row for category_id from a list of categories."""
+    for c in categories:
+        if c.id == category_id:
+            return c
+    return None
+
+
+def latestUpdate(categories):
+    """Returns the newest updated_at of the given categories, if any."""
+    stamps = [c.updated_at for c in categories if c.updated_at]
+    return max(stamps) if stamps else None
+
+
+def itemStamp(item):
+    """Returns when an item was last written."""
+    return item.updated_at or item.created_at
+
+
+def toUTC(timestamp):
+    """Converts a naive local timestamp to an aware UTC one."""
+    return timestamp.astimezone(datetime.timezone.utc)
+
+
+def conditional(version, last_modified, render, private=False,
+                cacheable=False):
+    """Returns 304 if the client's copy is current, else render()'s result.
+
+    version is any repr()-able value that changes whenever the response
+    would, and it is hashed into the ETag. render is only called when a
+    body has to be sent. Private responses also depend on who is logged
+    in and are never stored by shared caches. Cacheable pages are kept in
+    page_cache under their ETag while nobody is logged in.
+    """
+    if private:
+        # Flashed messages are shown once, so that page can't be reused
+        if '_flashes' in session:
+            return render()
+        # Pages also link to the current build of the static files
+        version = (version, session.get('user_id'),
+                   session.get('username'), session.get('picture'),
+                   appState().asset_manifest and
+                   appState().asset_manifest['version'])
+    etag = hashlib.sha1(repr(version).encode('utf-8')).hexdigest()
+    if last_modified is not None:
+        last_modified = toUTC(last_modified).replace(microsecond=0)
+
+    if request.if_none_match:
+        fresh = request.if_none_match.contains(etag)
+    elif request.if_modified_since and last_modified is not None:
+        since = request.if_modified_since
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=datetime.timezone.utc)
+        fresh = last_modified <= since
+    else:
+        fresh = False
+
+    if fresh:
+        response = make_response('', 304)
+    elif cacheable and 'username' not in session:
+        response = make_response(cachedPage(etag, render))
+    else:
+        response = make_response(render())
+        # Errors get no validators, so a retry is never answered with 304
+        if not 200 <= response.status_code < 300:
+            return response
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    if private:
+        response.cache_control.private = True
+        response.vary.add('Cookie')
+    return response
+
+
+def cachedPage(etag, render):
+    """Returns the page rendered for etag, rendering it on a miss.
+
+    The ETag hashes the version of everything on the page, read fresh
+    from the database, and the write paths bump those versions, so a
+    cached page is never out of date, even when workers share the cache.
+    """
+    page_cache = appState().page_cache
+    if page_cache is None:
+        return render()
+    key = '%s:%s' % (request.endpoint, etag)
+    page = page_cache.get(key)
+    if page is None:
+        page = render().encode('utf-8')
+        page_cache.set(key, page)
+    return page
+
 
 # Primary routes
 
@@ -145,135 +442,195 @@ def login_required(func):
     def decorated_function(*args, **kwargs):
         if 'username' not in session:
             flash('Please log in to manage items.')
-            return redirect(url_for('index'))
+            return redirect(url_for('catalog.index'))
         return func(*args, **kwargs)
     return decorated_function
 
 
-@app.route('/')
-@app.route('/catalog')
+@catalog.route('/')
+@catalog.route('/catalog')
 def index():
     """Default page route"""
-    categories = db_session.query(Category).all()
-    latest = db_session.query(Item).order_by(
-        Item.created_at.desc()).limit(10).all()
-    return render_template('default.html',
-                           categories=categories, latest=latest)
+    categories = currentCategories()
+
+    def render():
+        latest = getLatestItems()
+        return render_template('default.html',
+                               categories=categories, latest=latest)
+
+    last_modified = latestUpdate(categories)
+    return conditional(('index', categories), last_modified, render,
+                       private=True)
 
 
-@app.route('/catalog/<int:category_id>')
+@catalog.route('/catalog/<int:category_id>')
 def displayCategory(category_id):
     """Category page route"""
-    categories = db_session.query(Category).all()
-    item = db_session.query(Item).filter_by(id=category_id).one()
-    category = db_session.query(Category).filter_by(
-        id=item.category_id).one()
+    categories = currentCategories()
+    # Avoid a second database query by searching the already retrieved list
+    category = findCategory(categories, category_id)
+    if category is None:
+        abort(404)
 
-    # Avoid second database query by running loop in already retrieved data
-    for c in categories:
-        if c.id == category_id:
-            category = c
-            break
-    items = db_session.query(Item).filter_by(category_id=category.id).all()
-    return render_template(
-        'category.html', category=category, categories=categories, items=items)
+    def render():
+        items = getCategoryItems(category.id)
+        return render_template(
+            'category.html', category=category, categories=categories,
+            items=items)
 
+    # The page lists every category name but only this category's items
+    version = ('category', [(c.id, c.name) for c in categories], category)
+    return conditional(version, category.updated_at, render, private=True,
+                       cacheable=True)
 
-@app.route('/catalog/<int:category_id>/<item_id>')
+
+@catalog.route('/catalog/<int:category_id>/<item_id>')
 def displayItem(category_id, item_id):
     """Display item route"""
-    category = db_session.query(Category).filter_by(
-        id=category_id).one()
-    item = db_session.query(Item).filter_by(id=item_id).one()
-    return render_template(
-        'displayItem.html', item=item, category=category)
+    item = loadItem(item_id)
+    stamp = itemStamp(item)
+
+    def render():
+        return render_template(
+            'displayItem.html', item=item, category=item.category)
+
+    version = ('item', item.id, stamp, item.category.name)
+    return conditional(version, stamp, render, private=True,
+                       cacheable=True)
+
+
+def searchLimit():
+    """Reads the limit argument of a search request."""
+    try:
+        limit = int(request.args.get('limit', SEARCH_LIMIT))
+    except ValueError:
+        limit = SEARCH_LIMIT
+    return max(1, min(limit, SEARCH_MAX_LIMIT))
 
 
-@app.route('/catalog/<int:category_id>/new', methods=['POST', 'GET'])
+@catalog.route('/search')
+def search():
+    """Search results page route"""
+    terms = request.args.get('q', '')
+    results = searchItems(db_session, terms, searchLimit())
+    return render_template('search.html', terms=terms, results=results)
+
+
+@catalog.route('/catalog/<int:category_id>/new', methods=['POST', 'GET'])
 @login_required
 def createNew(category_id):
     """New item route."""
 
     # Create the new item
     if request.method == 'POST':
+        try:
+            picture = images.saveUpload(request.files.get('picture'))
+        except images.InvalidImage as e:
+            flash(str(e))
+            return redirect(url_for('catalog.createNew',
+                                    category_id=category_id))
         newItem = Item(
             category_id=int(request.form['category']),
             name=request.form['name'],
             description=request.form['description'],
+            picture=picture,
             created_at=datetime.datetime.now(),
             user_id=session['user_id'])
+        newItem.updated_at = newItem.created_at
 
         db_session.add(newItem)
+        touchCategories(newItem.category_id)
         db_session.flush()
+        stats.itemCreated(db_session, newItem)
+        change = changes.recordChange(db_session, newItem.id)
         db_session.commit()
+        read_cache.invalidate()
+        changes.compactIfDue(engine, change.seq)
         flash('Item successfully created.')
         return redirect(
-            url_for('displayItem', category_id=category_id,
+            url_for('catalog.displayItem', category_id=category_id,
                     item_id=newItem.id))
     else:
-        categories = db_session.query(Category).all()
+        categories = getCategories()
         return render_template('createNew.html', categories=categories)
 
 
-@app.route('/catalog/<int:item_id>/edit', methods=['POST', 'GET'])
+@catalog.route('/catalog/<int:item_id>/edit', methods=['POST', 'GET'])
 @login_required
 def edit(item_id):
     """Edit item route"""
 
-    item = db_session.query(Item).filter_by(id=item_id).one()
-    category = db_session.query(Category).filter_by(
-        id=item.category_id).one()
-    categories = db_session.query(Category).all()
-    for c in categories:
-        if c.id == item.category_id:
-            category = c
-            break
+    item = loadItem(item_id)
+    category = item.category
 
     # Other users are not allowed to edit items except the owner
     if item.user_id != session['user_id']:
         return redirect(
-            url_for('displayItem', category_id=category.id,
+            url_for('catalog.displayItem', category_id=category.id,
                     item_id=item.id))
 
     if request.method == 'POST':
+        try:
+            picture = images.saveUpload(request.files.get('picture'))
+        except images.InvalidImage as e:
+            flash(str(e))
+            return redirect(url_for('catalog.edit', item_id=item.id))
+        old_category_id = item.category_id
+        if picture:
+            item.picture = picture
         if request.form['category']:
-            item.category_id = request.form['category']
+            item.category_id = int(request.form['category'])
         if request.form['name']:
             item.name = request.form['name']
         if request.form['description']:
             item.description = request.form['description']
+        item.updated_at = datetime.datetime.now()
 
         db_session.add(item)
+        # Moving an item changes both the old and the new category
+        touchCategories(old_category_id, item.category_id)
+        if item.category_id != old_category_id:
+            db_session.flush()
+            stats.itemMoved(db_session, item, old_category_id)
+        change = changes.recordChange(db_session, item.id)
         db_session.commit()
+        read_cache.invalidate()
+        changes.compactIfDue(engine, change.seq)
         flash('Item succesfully updated.')
         return redirect(
-            url_for('displayItem', category_id=category.id, item_id=item.id))
+            url_for('catalog.displayItem', category_id=category.id,
+                    item_id=item.id))
     else:
         return render_template('edit.html', category=category,
-                               categories=categories, item=item)
+                               categories=getCategories(), item=item)
 
 
-@app.route('/catalog/<int:item_id>/delete', methods=['POST', 'GET'])
+@catalog.route('/catalog/<int:item_id>/delete', methods=['POST', 'GET'])
 @login_required
 def delete(item_id):
     """Item delete route"""
 
-    item = db_session.query(Item).filter_by(id=item_id).one()
-    category = db_session.query(Category).filter_by(
-        id=item.category_id).one()
+    item = loadItem(item_id)
+    category = item.category
 
     # Other users are not allowed to delete items except the owner
     if item.user_id != session['user_id']:
         return redirect(
-            url_for('displayItem', category_id=category.id,
+            url_for('catalog.displayItem', category_id=category.id,
                     item_id=item.id))
 
     if request.method == 'POST':
         db_session.delete(item)
+        touchCategories(item.category_id)
+        db_session.flush()
+        stats.itemDeleted(db_session, item)
+        change = changes.recordChange(db_session, item.id, deleted=True)
         db_session.commit()
+        read_cache.invalidate()
+        changes.compactIfDue(engine, change.seq)
         flash('Item successfully deleted.')
         return redirect(
-            url_for('displayCategory', category_id=category.id))
+            url_for('catalog.displayCategory', category_id=category.id))
     else:
         return render_template(
             'delete.html', category=category, item=item)
@@ -282,36 +639,495 @@ def delete(item_id):
 # API Endpoint for JSON
 
 
-@app.route('/api')
-@app.route('/catalog/api')
-def indexJSON():
-    categories = db_session.query(Category).all()
-    catalog = []
+# Page sizes for the cursor-paginated API
+API_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 1000
+
+# Columns clients can select with ?fields=, keyed by their serialized name
+ITEM_FIELDS = {
+    'id': Item.id,
+    'name': Item.name,
+    'description': Item.description,
+    'category': Item.category_id
+}
+
+# Query arguments that switch an API route into paginated mode
+PAGINATION_ARGS = ('limit', 'cursor', 'fields')
+
+
+def encodeCursor(created_at, item_id):
+    """Builds an opaque cursor pointing just past the given item."""
+    raw = '%s|%d' % (created_at.isoformat(), item_id)
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decodeCursor(cursor):
+    """Returns the (created_at, id) pair encoded in a cursor."""
+    raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+    created_at, item_id = raw.rsplit('|', 1)
+    return datetime.datetime.fromisoformat(created_at), int(item_id)
+
+
+def pageArgs():
+    """Parses the request's pagination arguments.
+
+    Returns (args, None), or (None, a 400 response) if any is invalid.
+    Routes check them before their ETag, so an invalid request can't be
+    answered with a 304.
+    """
+    fields = request.args.get('fields')
+    if fields:
+        names = [f.strip() for f in fields.split(',') if f.strip()]
+    else:
+        names = list(ITEM_FIELDS)
+    names = list(dict.fromkeys(names))
+    unknown = [f for f in names if f not in ITEM_FIELDS]
+    if unknown or not names:
+        return None, (jsonify(
+            error='Unknown fields: %s' % ','.join(unknown)), 400)
+
+    try:
+        limit = int(request.args.get('limit', API_PAGE_SIZE))
+    except ValueError:
+        return None, (jsonify(error='limit must be an integer'), 400)
+    if limit < 1:
+        return None, (jsonify(error='limit must be positive'), 400)
+    limit = min(limit, API_MAX_PAGE_SIZE)
+
+    after = None
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            after = decodeCursor(cursor)
+        except ValueError:
+            return None, (jsonify(error='Invalid cursor'), 400)
+    return {'names': names, 'limit': limit, 'after': after}, None
+
+
+def itemPage(mimetype, page_args, category_id=None):
+    """Returns one page of items ordered by (created_at, id).
+
+    Pages are fetched with keyset pagination, so the cost of a page does
+    not depend on how deep into the catalog it is.
+    """
+    names, limit = page_args['names'], page_args['limit']
+    # created_at and id are always selected because they form the cursor
+    extra = [f for f in names if f != 'id']
+    query = db_session.query(
+        Item.created_at, Item.id, *[ITEM_FIELDS[f] for f in extra])
+    if category_id is not None:
+        query = query.filter(Item.category_id == category_id)
+
+    if page_args['after'] is not None:
+        created_at, item_id = page_args['after']
+        # A row value comparison, unlike the equivalent OR, seeks the index
+        query = query.filter(
+            tuple_(Item.created_at, Item.id) > tuple_(created_at, item_id))
+
+    # Fetch one extra row to know whether there is a next page
+    rows = query.order_by(
+        Item.created_at, Item.id).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    items = []
+    for row in rows:
+        data = dict(zip(extra, row[2:]))
+        if 'id' in names:
+            data['id'] = row[1]
+        items.append(data)
+    next_cursor = encodeCursor(rows[-1][0], rows[-1][1]) if has_more else None
+    return apiBody(mimetype, Items=items, next_cursor=next_cursor)
+
+
+# Columns of an item as the API returns it, in serialized key order
+ITEM_COLUMNS = (Item.category_id, Item.description, Item.id, Item.name)
+
+
+def itemDicts(rows):
+    """Turns rows of ITEM_COLUMNS into what Item.serialize returns."""
+    return [{'category': r[0], 'description': r[1], 'id': r[2], 'name': r[3]}
+            for r in rows]
+
+
+def apiBody(mimetype, **data):
+    body = formats.encode(data, mimetype, appState().encodeJSON)
+    return Response(body, mimetype=mimetype)
+
+
+def apiResponse(version, last_modified, render):
+    """conditional() for API routes, in the format the client accepts.
+
+    render(mimetype) builds the uncompressed response, which is then
+    compressed as Accept-Encoding allows. Each format and content coding
+    is a separate representation with its own ETag. A version of None
+    sends the response without validators.
+    """
+    mimetype = formats.negotiateFormat(request.accept_mimetypes)
+    coding = formats.negotiateEncoding(request.accept_encodings)
+
+    def renderEncoded():
+        return formats.compressResponse(
+            make_response(render(mimetype)), coding)
+
+    if version is None:
+        response = renderEncoded()
+    else:
+        response = conditional(
+            (version, mimetype, coding), last_modified, renderEncoded)
+    response.vary.update(('Accept', 'Accept-Encoding'))
+    return response
+
+
+# Number of item rows fetched per query while streaming the full catalog
+EXPORT_CHUNK_SIZE = 1000
+
+# Streamed output is sent in pieces of about this many bytes
+EXPORT_BUFFER_SIZE = 64 * 1024
+
+
+def iterCatalogBatches(chunk_size=EXPORT_CHUNK_SIZE):
+    """Yields (category_id, rows) for all items, ordered by category.
+
+    Rows are fetched a chunk at a time, so one category's rows may come
+    in several consecutive batches.
+    """
+    last = None
+    while True:
+        query = db_session.query(*ITEM_COLUMNS)
+        if last is not None:
+            # Keyset pagination: seek right after the last row seen
+            query = query.filter(tuple_(Item.category_id, Item.id) >
+                                 tuple_(last.category_id, last.id))
+        rows = query.order_by(
+            Item.category_id, Item.id).limit(chunk_size).all()
+        for category_id, group in groupby(rows, attrgetter('category_id')):
+            yield category_id, list(group)
+        if len(rows) < chunk_size:
+            return
+        last = rows[-1]
+
+
+def iterCategoryItems(categories, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yields (category, [batch of rows, ...]) for every category.
+
+    categories must be ordered by id. Batches are generated lazily, and
+    items pointing at a missing category are skipped.
+    """
+    batches = iterCatalogBatches(chunk_size)
+    current = next(batches, None)
+
+    def categoryBatches(category_id):
+        nonlocal current
+        while current is not None and current[0] == category_id:
+            yield current[1]
+            current = next(batches, None)
+
     for c in categories:
-        catalog.append(c.serialize)
-        items = db_session.query(Item).filter_by(category_id=c.id).all()
-        catalog[-1]['Items'] = [i.serialize for i in items]
-    return jsonify(Categories=catalog)
+        while current is not None and current[0] < c.id:
+            current = next(batches, None)
+        yield c, categoryBatches(c.id)
+
+
+def bufferStream(pieces, size=EXPORT_BUFFER_SIZE):
+    """Joins small pieces of output into chunks of about size bytes."""
+    buffered = []
+    length = 0
+    for piece in pieces:
+        buffered.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield b''.join(buffered)
+            buffered = []
+            length = 0
+    if buffered:
+        yield b''.join(buffered)
+
+
+def streamCatalogJSON(categories, chunk_size=EXPORT_CHUNK_SIZE):
+    """Generates the full catalog JSON one category at a time.
+
+    The output is what jsonify(Categories=...) returns, encoded with the
+    app's encodeJSON, but only one chunk of items is held in memory at
+    any time.
+    """
+    encodeJSON = appState().encodeJSON
+    yield b'{"Categories":['
+    for n, (c, batches) in enumerate(iterCategoryItems(categories,
+                                                       chunk_size)):
+        yield b'{"Items":[' if n == 0 else b',{"Items":['
+        first = True
+        for rows in batches:
+            # Encode the whole batch at once and drop the list's brackets
+            encoded = encodeJSON(itemDicts(rows))[1:-1]
+            yield encoded if first else b',' + encoded
+            first = False
+        # Keys are sorted, so "Items" comes before "id" and "name"
+        yield b'],' + encodeJSON({'id': c.id, 'name': c.name})[1:]
+    yield b']}\n'
+
+
+def streamCatalogMsgpack(categories, chunk_size=EXPORT_CHUNK_SIZE):
+    """Generates the full catalog as MessagePack one category at a time.
+
+    MessagePack arrays start with their length, so each category's items
+    are packed before any of them is sent.
+    """
+    packer = formats.msgpack.Packer(use_bin_type=True)
+    yield packer.pack_map_header(1) + packer.pack('Categories')
+    yield packer.pack_array_header(len(categories))
+    for c, batches in iterCategoryItems(categories, chunk_size):
+        packed = []
+        for rows in batches:
+            packed.extend(packer.pack(item) for item in itemDicts(rows))
+        yield (packer.pack_map_header(3) + packer.pack('Items') +
+               packer.pack_array_header(len(packed)))
+        for piece in packed:
+            yield piece
+        yield (packer.pack('id') + packer.pack(c.id) +
+               packer.pack('name') + packer.pack(c.name))
+
+
+@catalog.route('/api')
+@catalog.route('/catalog/api')
+def indexJSON():
+    page_args = None
+    if any(arg in request.args for arg in PAGINATION_ARGS):
+        page_args, error = pageArgs()
+        if error is not None:
+            return error
+    categories = currentCategories()
+
+    def render(mimetype):
+        if page_args is not None:
+            return itemPage(mimetype, page_args)
+        if mimetype == formats.MSGPACK:
+            stream = streamCatalogMsgpack(categories)
+        else:
+            stream = streamCatalogJSON(categories)
+        return Response(stream_with_context(bufferStream(stream)),
+                        mimetype=mimetype)
+
+    last_modified = latestUpdate(categories)
+    version = ('api', categories, sorted(request.args.items()))
+    return apiResponse(version, last_modified, render)
 
 # Get all items in a single category with a given category id
-@app.route('/api/<int:category_id>')
+@catalog.route('/api/<int:category_id>')
 def categoryAPI(category_id):
-    items = db_session.query(Item).filter_by(category_id=category_id).all()
-    items_list = []
-    for i in items:
-        items_list.append(i.serialize)
-    print(items_list)
-    return jsonify(Items=items_list)
+    page_args = None
+    if any(arg in request.args for arg in PAGINATION_ARGS):
+        page_args, error = pageArgs()
+        if error is not None:
+            return error
+    current = findCategory(currentCategories(), category_id)
+
+    def render(mimetype):
+        if page_args is not None:
+            return itemPage(mimetype, page_args, category_id)
+        rows = db_session.query(*ITEM_COLUMNS).filter(
+            Item.category_id == category_id).all()
+        return apiBody(mimetype, Items=itemDicts(rows))
+
+    version = ('categoryAPI', current, sorted(request.args.items()))
+    last_modified = current.updated_at if current else None
+    return apiResponse(version, last_modified, render)
 
 # Get a single item with a given category and item ID
-@app.route('/api/<int:category_id>/<int:item_id>')
+@catalog.route('/api/<int:category_id>/<int:item_id>')
 def itemAPI(category_id, item_id):
-    items = db_session.query(Item).filter_by(id=item_id).one()
-    return jsonify(Item=items.serialize)
+    row = db_session.query(
+        Item.created_at, Item.updated_at, *ITEM_COLUMNS).filter(
+        Item.id == item_id).first()
+    if row is None:
+        abort(404)
+    stamp = itemStamp(row)
+
+    def render(mimetype):
+        return apiBody(mimetype, Item=itemDicts([row[2:]])[0])
+
+    return apiResponse(('itemAPI', item_id, stamp), stamp, render)
+
+# Uploaded pictures and their thumbnails
+@catalog.route('/images/<name>')
+def image(name):
+    stored = images.storedFile(name)
+    if stored is None:
+        abort(404)
+    path, is_thumbnail = stored
+    if not os.path.exists(path):
+        if not is_thumbnail:
+            abort(404)
+        # Not generated yet; browsers ask again on the next page view
+        response = send_from_directory(
+            current_app.static_folder, 'placeholder.svg', max_age=0)
+        response.cache_control.no_cache = True
+        return response
+    # Names are content hashes, so a file never changes
+    response = send_file(path, max_age=365 * 24 * 3600)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+# Fingerprinted static files, in the best encoding the client accepts
+@catalog.route('/assets/<path:name>')
+def asset(name):
+    # Old copies too, for pages rendered before the last build
+    copy = assets.findCopy(name)
+    if copy is None:
+        abort(404)
+    path, encodings = copy
+    coding = request.accept_encodings.best_match(encodings)
+    if coding is not None:
+        path = '%s.%s' % (path, assets.SUFFIXES[coding])
+    # Names change with the content, so a copy never does
+    response = send_file(
+        path, mimetype=mimetypes.guess_type(name)[0] or
+        'application/octet-stream', max_age=365 * 24 * 3600)
+    if coding is not None:
+        response.headers['Content-Encoding'] = coding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+# Create, update and delete many items in one transaction
+@catalog.route('/api/items/batch', methods=['POST'])
+def batchAPI():
+    # SeaSurf has already checked the X-CSRFToken header or the body's
+    # _csrf_token field
+    if 'username' not in session:
+        return jsonify(error='Log in to manage items'), 401
+    body = request.get_json(silent=True)
+    operations = body.get('operations') if isinstance(body, dict) else None
+    if not isinstance(operations, list) or not operations:
+        return jsonify(error='Send {"operations": [...]} as JSON'), 400
+    if len(operations) > batch.BATCH_MAX_OPERATIONS:
+        return jsonify(error='At most %d operations per batch'
+                       % batch.BATCH_MAX_OPERATIONS), 400
+
+    user_id = session['user_id']
+    category_ids = set(c.id for c in getCategories())
+    # Check the batch under the write lock, so that no item it updates or
+    # deletes can change before it is written
+    batch.lockForWrite(db_session)
+    errors, owners = batch.validateBatch(
+        db_session, operations, category_ids, user_id)
+    invalid = len([e for e in errors if e is not None])
+    if invalid:
+        db_session.rollback()
+        results = []
+        for operation, error in zip(operations, errors):
+            op = operation.get('op') if isinstance(operation, dict) else None
+            if error is None:
+                results.append({'op': op, 'status': 'skipped'})
+            else:
+                results.append({'op': op, 'status': 'invalid',
+                                'error': error})
+        return jsonify(
+            error='%d invalid operations, nothing was written' % invalid,
+            results=results), 400
+
+    touched = batch.touchedCategories(operations, owners)
+    touchCategories(*touched)
+    results, written, deleted = batch.applyBatch(
+        db_session, operations, user_id)
+    # Cheaper than adjusting the statistics once per item of a large batch
+    stats.rebuildStats(db_session, touched, [user_id])
+    changes.recordChanges(db_session, written)
+    changes.recordChanges(db_session, deleted, deleted=True)
+    seq = changes.latestSeq(db_session)
+    db_session.commit()
+    read_cache.invalidate()
+    changes.compactIfDue(engine, seq, len(written) + len(deleted))
+    return jsonify(results=results)
+
+# Items changed since a seq, for clients that mirror the catalog
+@catalog.route('/api/changes')
+def changesAPI():
+    def render(mimetype):
+        if 'since' not in request.args:
+            # Where to start following, taken before downloading /api
+            return apiBody(mimetype, Changes=[],
+                           next_since=changes.latestSeq(db_session),
+                           has_more=False)
+        try:
+            since = int(request.args['since'])
+            limit = int(request.args.get('limit', changes.CHANGES_LIMIT))
+        except ValueError:
+            return jsonify(error='since and limit must be integers'), 400
+        if since < 0 or limit < 1:
+            return jsonify(
+                error='since must not be negative, limit must be positive'
+            ), 400
+        limit = min(limit, changes.CHANGES_MAX_LIMIT)
+
+        page, has_more = changes.listChanges(db_session, since, limit)
+        next_since = page[-1]['seq'] if page else since
+        return apiBody(mimetype, Changes=page, next_since=next_since,
+                       has_more=has_more)
+
+    return apiResponse(None, None, render)
+
+# Full-text search over item names and descriptions
+@catalog.route('/api/search')
+def searchAPI():
+    results = searchItems(
+        db_session, request.args.get('q', ''), searchLimit())
+    return jsonify(Items=results)
+
+def statsDict(row):
+    """Returns the item statistics of a category or user row."""
+    last_added_at = row.last_added_at
+    return {
+        'id': row.id,
+        'item_count': row.item_count,
+        'latest_item_id': row.latest_item_id,
+        'last_added_at': last_added_at.isoformat() if last_added_at else None
+    }
+
+
+# Item counts and newest items, read from the category list
+@catalog.route('/api/stats')
+def statsAPI():
+    categories = currentCategories()
+
+    def render(mimetype):
+        data = []
+        for c in categories:
+            data.append(dict(statsDict(c), name=c.name))
+        return apiBody(mimetype, Categories=data,
+                       item_count=sum(c.item_count for c in categories))
+
+    return apiResponse(('stats', categories), latestUpdate(categories),
+                       render)
+
+# One user's item count and newest item
+@catalog.route('/api/stats/users/<int:user_id>')
+def userStatsAPI(user_id):
+    user = db_session.query(
+        User.id, User.item_count, User.latest_item_id,
+        User.last_added_at).filter(User.id == user_id).first()
+    if user is None:
+        abort(404)
+
+    def render(mimetype):
+        return apiBody(mimetype, User=statsDict(user))
+
+    return apiResponse(('userStats', tuple(user)), None, render)
+
+# Read cache hit/miss counters
+@catalog.route('/api/cache')
+def cacheStats():
+    page_cache = appState().page_cache
+    stats = read_cache.stats()
+    stats['pages'] = page_cache.stats() if page_cache is not None else None
+    return jsonify(stats)
 
 if __name__ == "__main__":
-    app.secret_key = 'super secret key'
-    app.debug = True
-    app.config['TEMPLATES_AUTO_RELOAD'] = True
+    app = create_app({'SECRET_KEY': 'super secret key', 'DEBUG': True,
+                      'TEMPLATES_AUTO_RELOAD': True})
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port)
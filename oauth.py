@@ -0,0 +1,96 @@
+"""Google OAuth helpers used by the login routes.
+
+client_secrets.json is parsed and the oauth2 API client is built once per
+process instead of on every login. HTTP calls go through a keep-alive
+httplib2.Http per thread, because an Http object must not be shared
+between threads. Credentials are added to each request's headers rather
+than wrapped around the shared Http.
+
+The client libraries take longer to import than the rest of the app, so
+they are imported on the first login instead of when a worker starts.
+
+The endpoints come from client_secrets.json and, if GOOGLE_DISCOVERY_URL
+is set, from that discovery document. Point both at a local stub server
+to exercise the login flow offline.
+"""
+import os
+import threading
+
+CLIENT_SECRETS = os.environ.get('OAUTH_CLIENT_SECRETS', 'client_secrets.json')
+DISCOVERY_URL = os.environ.get('GOOGLE_DISCOVERY_URL')
+
+# Seconds before a call to the OAuth provider gives up
+HTTP_TIMEOUT = float(os.environ.get('OAUTH_HTTP_TIMEOUT', 10))
+
+SCOPES = ['https://www.googleapis.com/auth/userinfo.profile',
+          'https://www.googleapis.com/auth/userinfo.email']
+
+
+class SecretsCache(object):
+    """In-process cache oauth2client keeps parsed client secrets in."""
+
+    def __init__(self):
+        self._values = {}
+
+    def get(self, key, namespace=None):
+        return self._values.get((namespace, key))
+
+    def set(self, key, value, namespace=None):
+        self._values[(namespace, key)] = value
+
+
+secrets_cache = SecretsCache()
+_local = threading.local()
+_service_lock = threading.Lock()
+_service = None
+
+
+def pooledHttp():
+    """Returns this thread's keep-alive HTTP transport."""
+    http = getattr(_local, 'http', None)
+    if http is None:
+        import httplib2
+        http = _local.http = httplib2.Http(timeout=HTTP_TIMEOUT)
+    return http
+
+
+def userInfoService():
+    """Returns the oauth2 v2 API client, building it on first use."""
+    global _service
+    with _service_lock:
+        if _service is None:
+            from apiclient import discovery
+            options = {'http': pooledHttp(), 'cache_discovery': False}
+            if DISCOVERY_URL:
+                options['discoveryServiceUrl'] = DISCOVERY_URL
+            _service = discovery.build('oauth2', 'v2', **options)
+    return _service
+
+
+def buildFlow(redirect_uri):
+    """Returns the authorization flow described by client_secrets.json."""
+    from oauth2client import client
+    return client.flow_from_clientsecrets(
+        CLIENT_SECRETS, scope=SCOPES, redirect_uri=redirect_uri,
+        cache=secrets_cache)
+
+
+def exchangeCode(flow, code):
+    """Upgrades an authorization code to credentials."""
+    return flow.step2_exchange(code, http=pooledHttp())
+
+
+def loadCredentials(credentials_json):
+    from oauth2client import client
+    return client.OAuth2Credentials.from_json(credentials_json)
+
+
+def fetchUserInfo(credentials):
+    """Returns the Google profile of the credentials' owner."""
+    request = userInfoService().userinfo().v2().me().get()
+    credentials.apply(request.headers)
+    return request.execute(http=pooledHttp())
+
+
+def revoke(credentials):
+    credentials.revoke(pooledHttp())
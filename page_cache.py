@@ -0,0 +1,162 @@
+"""Caches for fully rendered pages.
+
+Pages are stored under a key that already contains the version of the data
+they show, so entries never need to be invalidated; an outdated page is
+simply never asked for again and ages out of the memory budget.
+
+Two backends share the same get/set/stats interface:
+
+* MemoryPageCache keeps pages in this process, least recently used first
+  out once max_bytes is exceeded.
+* FilePageCache keeps one file per page in a directory, so every worker
+  process on the machine shares it. A directory on a tmpfs such as
+  /dev/shm makes it a shared-memory cache.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class MemoryPageCache(object):
+    """In-process LRU cache bounded by the total size of its pages."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            page = self._pages.get(key)
+            if page is None:
+                self.misses += 1
+                return None
+            self._pages.move_to_end(key)
+            self.hits += 1
+            return page
+
+    def set(self, key, page):
+        if len(page) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._pages.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._pages[key] = page
+            self.size += len(page)
+            while self.size > self.max_bytes:
+                _, evicted = self._pages.popitem(last=False)
+                self.size -= len(evicted)
+
+    def stats(self):
+        with self._lock:
+            return {'backend': 'memory', 'hits': self.hits,
+                    'misses': self.misses, 'pages': len(self._pages),
+                    'bytes': self.size, 'max_bytes': self.max_bytes}
+
+
+class FilePageCache(object):
+    """Cache storing each page as a file, shared by all worker processes.
+
+    Pages are written to a temporary file and renamed into place, so
+    readers never see a partial page. Reads refresh a file's mtime, and
+    when the directory outgrows max_bytes the least recently read files
+    are removed until it is back under 80% of the budget.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Estimate of the directory size; corrected by every sweep
+        self._size = sum(size for _, size, _ in self._files())
+
+    def _path(self, key):
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name + '.page')
+
+    def _files(self):
+        """Yields (path, size, mtime) for every cached page."""
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.page'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    # Removed by another process in the meantime
+                    continue
+                yield entry.path, stat.st_size, stat.st_mtime
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                page = f.read()
+            os.utime(path, None)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return page
+
+    def set(self, key, page):
+        if len(page) > self.max_bytes:
+            return
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(page)
+            os.replace(temp_path, self._path(key))
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+        with self._lock:
+            self._size += len(page)
+            if self._size > self.max_bytes:
+                self._sweep()
+
+    def _sweep(self):
+        files = sorted(self._files(), key=lambda f: f[2])
+        size = sum(f[1] for f in files)
+        target = self.max_bytes * 0.8
+        for path, file_size, _ in files:
+            if size <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            size -= file_size
+        self._size = size
+
+    def stats(self):
+        with self._lock:
+            return {'backend': 'file', 'hits': self.hits,
+                    'misses': self.misses, 'bytes': self._size,
+                    'max_bytes': self.max_bytes,
+                    'directory': self.directory}
+
+
+def createPageCache(backend, max_bytes):
+    """Returns the cache named by backend, or None to disable caching.
+
+    backend is 'memory', 'none' or 'file:<directory>'.
+    """
+    if backend == 'none':
+        return None
+    if backend == 'memory':
+        return MemoryPageCache(max_bytes)
+    if backend.startswith('file:'):
+        return FilePageCache(backend[len('file:'):], max_bytes)
+    raise ValueError('Unknown page cache backend: %s' % backend)
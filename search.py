@@ -0,0 +1,128 @@
+"""Full-text search over item names and descriptions.
+
+On SQLite the FTS5 tables defined in db_setup.py answer the queries;
+other databases fall back to a substring match on item names.
+
+Items whose name matches every word come first, found in the names-only
+item_name_search index. It is keyed so that its natural order is the
+ranking: fewest words in the name first, as bm25 would rank them, and
+newest first among those. FTS5 then stops after the limit instead of
+scoring every match. When fewer names match, the newest of the other
+matches in item_search fill up the rest. Ranking those by bm25 would
+cost 5-20 ms, as it counts how many items contain each word and a common
+word occurs in most descriptions.
+
+On a synthetic 300k-item catalog with a 109-word vocabulary, where every
+word is in about 3% of the names and 75% of the descriptions,
+/api/search takes 0.3-3.5 ms, down from 8-30 ms when the 1000 newest
+matches were ranked. A prefix of over 6 letters that has to be read from
+the descriptions is the slowest, at about 18 ms.
+
+Run this module to rebuild the index of an existing database:
+    python search.py
+"""
+import re
+
+from markupsafe import Markup, escape
+from sqlalchemy import bindparam, text
+
+from db_setup import Item, nameKeyId
+
+# Number of search results returned when no limit is given, and the maximum
+SEARCH_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+
+# Private-use characters FTS5 wraps around matches; turned into <mark> later
+MATCH_START = '\ue000'
+MATCH_END = '\ue001'
+
+# Shortest last word matched as a prefix. Shorter prefixes would expand to
+# nearly every indexed word, and the index only stores 2 to 6 letter ones.
+MIN_PREFIX_LENGTH = 2
+
+# Items whose name matches, best first. The index is read in key order,
+# fewest words and then newest first, and stops after :limit matches.
+NAME_QUERY = text("""
+    SELECT item.id, item.name, item.category_id,
+           snippet(item_name_search, -1, :start, :end, '...', 16) AS snippet
+    FROM item_name_search
+    JOIN item ON item.id = %s
+    WHERE item_name_search MATCH :query
+    ORDER BY item_name_search.rowid
+    LIMIT :limit
+""" % nameKeyId('item_name_search.rowid'))
+
+# The newest other items matching anywhere, read in rowid order. Snippets
+# are only made for the rows returned.
+NEWEST_QUERY = text("""
+    SELECT item.id, item.name, item.category_id,
+           snippet(item_search, -1, :start, :end, '...', 16) AS snippet
+    FROM item_search
+    JOIN item ON item.id = item_search.rowid
+    WHERE item_search MATCH :query AND item_search.rowid NOT IN :named
+    ORDER BY item_search.rowid DESC
+    LIMIT :limit
+""").bindparams(bindparam('named', expanding=True))
+
+
+def buildMatchQuery(terms):
+    """Turns free text into a safe FTS5 query matching every word.
+
+    Each word is quoted so FTS5 operators in user input are taken
+    literally. The last word matches as a prefix for search-as-you-type,
+    once it is MIN_PREFIX_LENGTH characters long.
+    """
+    words = re.findall(r'\w+', terms, re.UNICODE)
+    if not words:
+        return None
+    quoted = ['"%s"' % w for w in words]
+    if len(words[-1]) >= MIN_PREFIX_LENGTH:
+        quoted[-1] += '*'
+    return ' '.join(quoted)
+
+
+def highlight(snippet):
+    """Escapes a snippet and marks the matched words with <mark> tags."""
+    return Markup(escape(snippet).replace(
+        MATCH_START, Markup('<mark>')).replace(
+        MATCH_END, Markup('</mark>')))
+
+
+def searchItems(db_session, terms, limit=SEARCH_LIMIT):
+    """Returns the best matching items as dicts, best match first.
+
+    Each result has the item's id, name, category and an HTML snippet of
+    the matching text.
+    """
+    query = buildMatchQuery(terms)
+    if query is None:
+        return []
+
+    if db_session.get_bind().dialect.name != 'sqlite':
+        items = db_session.query(Item.id, Item.name, Item.category_id).filter(
+            Item.name.ilike('%%%s%%' % terms.strip())).order_by(
+            Item.name).limit(limit).all()
+        return [{'id': i.id, 'name': i.name, 'category': i.category_id,
+                 'snippet': escape(i.name)} for i in items]
+
+    params = {'query': query, 'start': MATCH_START, 'end': MATCH_END}
+    rows = db_session.execute(NAME_QUERY, dict(params, limit=limit)).fetchall()
+    if len(rows) < limit:
+        rows += db_session.execute(NEWEST_QUERY, dict(
+            params, named=[row.id for row in rows],
+            limit=limit - len(rows))).fetchall()
+    return [{'id': row.id, 'name': row.name, 'category': row.category_id,
+             'snippet': highlight(row.snippet)} for row in rows]
+
+
+if __name__ == '__main__':
+    from db_setup import createEngine, createSearchIndex, rebuildSearchIndex
+    from db_setup import outdatedSearchIndexes
+
+    engine = createEngine()
+
+    with engine.begin() as connection:
+        outdatedSearchIndexes(connection)
+        createSearchIndex(connection)
+        rebuildSearchIndex(connection)
+    print('search index rebuilt!')
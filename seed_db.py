@@ -1,123 +1,360 @@
+"""Seeds the catalog database.
+
+With no arguments the sample user, categories and nine anime are added.
+Pass --items (and optionally --users and --categories) to bulk load a
+synthetic catalog of any size instead, e.g.:
+
+    python seed_db.py --users 1000 --categories 50 --items 1000000
+
+The database must already have its tables; run db_setup.py first.
+"""
+import argparse
 import datetime
-from sqlalchemy import create_engine
+import itertools
+import random
+import time
+from sqlalchemy import select
 from sqlalchemy.orm import sessionmaker
 
-from db_setup import Base, User, Category, Item
-
-# Connect db
-engine = create_engine('sqlite:///catalog.db')
-Base.metadata.bind = engine
-DBSession = sessionmaker(bind=engine)
-
-# Create sesstion to perform mutations
-db_session = DBSession()
-
-# Dummy user
-user1 = User(name="Test User", email="test123@gmail.com")
-
-# Dummy categories
-category1 = Category(name="Action")
-category2 = Category(name="Adventure")
-category3 = Category(name="Demons")
-category4 = Category(name="Shounen")
-category5 = Category(name="Slice of Life")
-category6 = Category(name="Horror")
-category7 = Category(name="Sports")
-
-
-db_session.add(category1)
-db_session.add(category2)
-db_session.add(category3)
-db_session.add(category4)
-db_session.add(category5)
-db_session.add(category6)
-db_session.add(category7)
-
-# commit categories
-db_session.commit()
-
-item1 = Item(name="Shingeki no Kyojin",
-             description="Centuries ago, mankind was slaughtered to near extinction by monstrous humanoid creatures called titans, forcing humans to hide in fear behind enormous concentric walls. What makes these giants truly terrifying is that their taste for human flesh is not born out of hunger but what appears to be out of pleasure. To ensure their survival, the remnants of humanity began living within defensive barriers, resulting in one hundred years without a single titan encounter. However, that fragile calm is soon shattered when a colossal titan manages to breach the supposedly impregnable outer wall, reigniting the fight for survival against the man-eating abominations.",
-             created_at=datetime.datetime.now(),
-             updated_at=datetime.datetime.now(),
-             category=category1,
-             user=user1)
-
-item2 = Item(name="Fullmetal Alchemist: Brotherhood",
-             description="In order for something to be obtained, something of equal value must be lost.Alchemy is bound by this Law of Equivalent Exchange—something the young brothers Edward and Alphonse Elric only realize after attempting human transmutation: the one forbidden act of alchemy. They pay a terrible price for their transgression—Edward loses his left leg, Alphonse his physical body. It is only by the desperate sacrifice of Edward's right arm that he is able to affix Alphonse's soul to a suit of armor. Devastated and alone, it is the hope that they would both eventually return to their original bodies that gives Edward the inspiration to obtain metal limbs called 'automail' and become a state alchemist, the Fullmetal Alchemist. Three years of searching later, the brothers seek the Philosopher's Stone, a mythical relic that allows an alchemist to overcome the Law of Equivalent Exchange. Even with military allies Colonel Roy Mustang, Lieutenant Riza Hawkeye, and Lieutenant Colonel Maes Hughes on their side, the brothers find themselves caught up in a nationwide conspiracy that leads them not only to the true nature of the elusive Philosopher's Stone, but their country's murky history as well. In between finding a serial killer and racing against time, Edward and Alphonse must ask themselves if what they are doing will make them human again... or take away their humanity.",
-             created_at=datetime.datetime.now(),
-             updated_at=datetime.datetime.now(),
-             category=category1,
-             user=user1)
-
-item3 = Item(name="Naruto",
-             description="Moments prior to Naruto Uzumaki's birth, a huge demon known as the Kyuubi, the Nine-Tailed Fox,"
-             "attacked Konohagakure, the Hidden Leaf Village, and wreaked havoc. In order to put an end to the Kyuubi's rampage,"
-             "the leader of the village, the Fourth Hokage, sacrificed his life and sealed the monstrous beast inside the newborn Naruto."
-             "Now, Naruto is a hyperactive and knuckle-headed ninja still living in Konohagakure. Shunned because of the Kyuubi inside him,"
-             "Naruto struggles to find his place in the village, while his burning desire to become the Hokage of Konohagakure leads him not"
-             "only to some great new friends, but also some deadly foes.",
-             created_at=datetime.datetime.now(),
-             updated_at=datetime.datetime.now(),
-             category=category2,
-             user=user1)
-
-item4 = Item(name="Hunter x Hunter",
-             description="Hunters are specialized in a wide variety of fields, ranging from treasure hunting to cooking. They have access to otherwise unavailable funds and information that allow them to pursue their dreams and interests. However, being a hunter is a special privilege, only attained by taking a deadly exam with an extremely low success rate."
-            "Gon Freecss, a 12-year-old boy with the hope of finding his missing father, sets out on a quest to take the Hunter Exam. Along the way, he picks up three companions who also aim to take the dangerous test: the revenge-seeking Kurapika, aspiring doctor Leorio Paladiknight, and a mischievous child the same age as Gon, Killua Zoldyck."
-            "Hunter x Hunter is a classic shounen that follows the story of four aspiring hunters as they embark on a perilous adventure, fighting for their dreams while defying the odds.",
-             created_at=datetime.datetime.now(),
-             updated_at=datetime.datetime.now(),
-             category=category2,
-             user=user1)
-
-item5 = Item(name="Kimetsu no Yaiba",
-             description="Ever since the death of his father, the burden of supporting the family has fallen upon Tanjirou Kamado's shoulders. Though living impoverished on a remote mountain, the Kamado family are able to enjoy a relatively peaceful and happy life. One day, Tanjirou decides to go down to the local village to make a little money selling charcoal. On his way back, night falls, forcing Tanjirou to take shelter in the house of a strange man, who warns him of the existence of flesh-eating demons that lurk in the woods at night. When he finally arrives back home the next day, he is met with a horrifying sight—his whole family has been slaughtered. Worse still, the sole survivor is his sister Nezuko, who has been turned into a bloodthirsty demon. Consumed by rage and hatred, Tanjirou swears to avenge his family and stay by his only remaining sibling. Alongside the mysterious group calling themselves the Demon Slayer Corps, Tanjirou will do whatever it takes to slay the demons and protect the remnants of his beloved sister's humanity.",
-             created_at=datetime.datetime.now(),
-             updated_at=datetime.datetime.now(),
-             category=category3,
-             user=user1)
-
-item6 = Item(name="Boku no Hero Academia",
-             description="The appearance of 'quirks,' newly discovered super powers, has been steadily increasing over the years, with 80 percent of humanity possessing various abilities from manipulation of elements to shapeshifting. This leaves the remainder of the world completely powerless, and Izuku Midoriya is one such individual.Since he was a child, the ambitious middle schooler has wanted nothing more than to be a hero. Izuku's unfair fate leaves him admiring heroes and taking notes on them whenever he can. But it seems that his persistence has borne some fruit: Izuku meets the number one hero and his personal idol, All Might. All Might's quirk is a unique ability that can be inherited, and he has chosen Izuku to be his successor! Enduring many months of grueling training, Izuku enrolls in UA High, a prestigious high school famous for its excellent hero training program, and this year's freshmen look especially promising. With his bizarre but talented classmates and the looming threat of a villainous organization, Izuku will soon learn what it really means to be a hero.",
-             created_at=datetime.datetime.now(),
-             updated_at=datetime.datetime.now(),
-             category=category4,
-             user=user1)
-
-item7 = Item(name="Toradora!",
-             description="Ryuuji Takasu is a gentle high school student with a love for housework; but in contrast to his kind nature, he has an intimidating face that often gets him labeled as a delinquent. On the other hand is Taiga Aisaka, a small, doll-like student, who is anything but a cute and fragile girl. Equipped with a wooden katana and feisty personality, Taiga is known throughout the school as the 'Palmtop Tiger.'One day, an embarrassing mistake causes the two students to cross paths. Ryuuji discovers that Taiga actually has a sweet side: she has a crush on the popular vice president, Yuusaku Kitamura, who happens to be his best friend. But things only get crazier when Ryuuji reveals that he has a crush on Minori Kushieda—Taiga's best friend!Toradora! is a romantic comedy that follows this odd duo as they embark on a quest to help each other with their respective crushes, forming an unlikely alliance in the process.",
-             created_at=datetime.datetime.now(),
-             updated_at=datetime.datetime.now(),
-             category=category5,
-             user=user1)
-
-item8 = Item(name="Another",
-             description="In 1972, a popular student in Yomiyama North Middle School's class 3-3 named Misaki passed away during the school year. Since then, the town of Yomiyama has been shrouded by a fearful atmosphere, from the dark secrets hidden deep within.Twenty-six years later, 15-year-old Kouichi Sakakibara transfers into class 3-3 of Yomiyama North and soon after discovers that a strange, gloomy mood seems to hang over all the students. He also finds himself drawn to the mysterious, eyepatch-wearing student Mei Misaki; however, the rest of the class and the teachers seem to treat her like she doesn't exist. Paying no heed to warnings from everyone including Mei herself, Kouichi begins to get closer not only to her, but also to the truth behind the gruesome phenomenon plaguing class 3-3 of Yomiyama North.Another follows Kouichi, Mei, and their classmates as they are pulled into the enigma surrounding a series of inevitable, tragic events—but unraveling the horror of Yomiyama may just cost them the ultimate price.",
-             created_at=datetime.datetime.now(),
-             updated_at=datetime.datetime.now(),
-             category=category6,
-             user=user1)
-
-item9 = Item(name="Haikyuu!!",
-             description="Inspired after watching a volleyball ace nicknamed 'Little Giant' in action, small-statured Shouyou Hinata revives the volleyball club at his middle school. The newly-formed team even makes it to a tournament; however, their first match turns out to be their last when they are brutally squashed by the 'King of the Court,' Tobio Kageyama. Hinata vows to surpass Kageyama, and so after graduating from middle school, he joins Karasuno High School's volleyball team—only to find that his sworn rival, Kageyama, is now his teammate.Thanks to his short height, Hinata struggles to find his role on the team, even with his superior jumping power. Surprisingly, Kageyama has his own problems that only Hinata can help with, and learning to work together appears to be the only way for the team to be successful. Based on Haruichi Furudate's popular shounen manga of the same name, Haikyuu!! is an exhilarating and emotional sports comedy following two determined athletes as they attempt to patch a heated rivalry in order to make their high school volleyball team the best in Japan.",
-             created_at=datetime.datetime.now(),
-             updated_at=datetime.datetime.now(),
-             category=category7,
-             user=user1)
-
-db_session.add(item1)
-db_session.add(item2)
-db_session.add(item3)
-db_session.add(item4)
-db_session.add(item5)
-db_session.add(item6)
-db_session.add(item7)
-db_session.add(item8)
-db_session.add(item9)
-
-# COmmit created items to the db
-db_session.commit()
-
-# Print completion message
-print("added catalog items!")
+from db_setup import DATABASE_URL, User, Category, Item, createEngine
+from db_setup import createIndexes, dropSearchTriggers, rebuildSearchIndex
+from stats import rebuildStats
+
+# Bound to the database by connect()
+engine = None
+DBSession = sessionmaker()
+
+
+def connect(url=DATABASE_URL):
+    """Points the seeding functions at the database at url."""
+    global engine
+    engine = createEngine(url)
+    DBSession.configure(bind=engine)
+
+
+def seedAnime():
+    """Adds the sample user, categories and nine anime."""
+    # Create sesstion to perform mutations
+    db_session = DBSession()
+
+    # Dummy user
+    user1 = User(name="Test User", email="test123@gmail.com")
+
+    # Dummy categories
+    category1 = Category(name="Action")
+    category2 = Category(name="Adventure")
+    category3 = Category(name="Demons")
+    category4 = Category(name="Shounen")
+    category5 = Category(name="Slice of Life")
+    category6 = Category(name="Horror")
+    category7 = Category(name="Sports")
+
+
+    db_session.add(category1)
+    db_session.add(category2)
+    db_session.add(category3)
+    db_session.add(category4)
+    db_session.add(category5)
+    db_session.add(category6)
+    db_session.add(category7)
+
+    # commit categories
+    db_session.commit()
+
+    item1 = Item(name="Shingeki no Kyojin",
+                 description="Centuries ago, mankind was slaughtered to near extinction by monstrous humanoid creatures called titans, forcing humans to hide in fear behind enormous concentric walls. What makes these giants truly terrifying is that their taste for human flesh is not born out of hunger but what appears to be out of pleasure. To ensure their survival, the remnants of humanity began living within defensive barriers, resulting in one hundred years without a single titan encounter. However, that fragile calm is soon shattered when a colossal titan manages to breach the supposedly impregnable outer wall, reigniting the fight for survival against the man-eating abominations.",
+                 created_at=datetime.datetime.now(),
+                 updated_at=datetime.datetime.now(),
+                 category=category1,
+                 user=user1)
+
+    item2 = Item(name="Fullmetal Alchemist: Brotherhood",
+                 description="In order for something to be obtained, something of equal value must be lost.Alchemy is bound by this Law of Equivalent Exchange—something the young brothers Edward and Alphonse Elric only realize after attempting human transmutation: the one forbidden act of alchemy. They pay a terrible price for their transgression—Edward loses his left leg, Alphonse his physical body. It is only by the desperate sacrifice of Edward's right arm that he is able to affix Alphonse's soul to a suit of armor. Devastated and alone, it is the hope that they would both eventually return to their original bodies that gives Edward the inspiration to obtain metal limbs called 'automail' and become a state alchemist, the Fullmetal Alchemist. Three years of searching later, the brothers seek the Philosopher's Stone, a mythical relic that allows an alchemist to overcome the Law of Equivalent Exchange. Even with military allies Colonel Roy Mustang, Lieutenant Riza Hawkeye, and Lieutenant Colonel Maes Hughes on their side, the brothers find themselves caught up in a nationwide conspiracy that leads them not only to the true nature of the elusive Philosopher's Stone, but their country's murky history as well. In between finding a serial killer and racing against time, Edward and Alphonse must ask themselves if what they are doing will make them human again... or take away their humanity.",
+                 created_at=datetime.datetime.now(),
+                 updated_at=datetime.datetime.now(),
+                 category=category1,
+                 user=user1)
+
+    item3 = Item(name="Naruto",
+                 description="Moments prior to Naruto Uzumaki's birth, a huge demon known as the Kyuubi, the Nine-Tailed Fox,"
+                 "attacked Konohagakure, the Hidden Leaf Village, and wreaked havoc. In order to put an end to the Kyuubi's rampage,"
+                 "the leader of the village, the Fourth Hokage, sacrificed his life and sealed the monstrous beast inside the newborn Naruto."
+                 "Now, Naruto is a hyperactive and knuckle-headed ninja still living in Konohagakure. Shunned because of the Kyuubi inside him,"
+                 "Naruto struggles to find his place in the village, while his burning desire to become the Hokage of Konohagakure leads him not"
+                 "only to some great new friends, but also some deadly foes.",
+                 created_at=datetime.datetime.now(),
+                 updated_at=datetime.datetime.now(),
+                 category=category2,
+                 user=user1)
+
+    item4 = Item(name="Hunter x Hunter",
+                 description="Hunters are specialized in a wide variety of fields, ranging from treasure hunting to cooking. They have access to otherwise unavailable funds and information that allow them to pursue their dreams and interests. However, being a hunter is a special privilege, only attained by taking a deadly exam with an extremely low success rate."
+                "Gon Freecss, a 12-year-old boy with the hope of finding his missing father, sets out on a quest to take the Hunter Exam. Along the way, he picks up three companions who also aim to take the dangerous test: the revenge-seeking Kurapika, aspiring doctor Leorio Paladiknight, and a mischievous child the same age as Gon, Killua Zoldyck."
+                "Hunter x Hunter is a classic shounen that follows the story of four aspiring hunters as they embark on a perilous adventure, fighting for their dreams while defying the odds.",
+                 created_at=datetime.datetime.now(),
+                 updated_at=datetime.datetime.now(),
+                 category=category2,
+                 user=user1)
+
+    item5 = Item(name="Kimetsu no Yaiba",
+                 description="Ever since the death of his father, the burden of supporting the family has fallen upon Tanjirou Kamado's shoulders. Though living impoverished on a remote mountain, the Kamado family are able to enjoy a relatively peaceful and happy life. One day, Tanjirou decides to go down to the local village to make a little money selling charcoal. On his way back, night falls, forcing Tanjirou to take shelter in the house of a strange man, who warns him of the existence of flesh-eating demons that lurk in the woods at night. When he finally arrives back home the next day, he is met with a horrifying sight—his whole family has been slaughtered. Worse still, the sole survivor is his sister Nezuko, who has been turned into a bloodthirsty demon. Consumed by rage and hatred, Tanjirou swears to avenge his family and stay by his only remaining sibling. Alongside the mysterious group calling themselves the Demon Slayer Corps, Tanjirou will do whatever it takes to slay the demons and protect the remnants of his beloved sister's humanity.",
+                 created_at=datetime.datetime.now(),
+                 updated_at=datetime.datetime.now(),
+                 category=category3,
+                 user=user1)
+
+    item6 = Item(name="Boku no Hero Academia",
+                 description="The appearance of 'quirks,' newly discovered super powers, has been steadily increasing over the years, with 80 percent of humanity possessing various abilities from manipulation of elements to shapeshifting. This leaves the remainder of the world completely powerless, and Izuku Midoriya is one such individual.Since he was a child, the ambitious middle schooler has wanted nothing more than to be a hero. Izuku's unfair fate leaves him admiring heroes and taking notes on them whenever he can. But it seems that his persistence has borne some fruit: Izuku meets the number one hero and his personal idol, All Might. All Might's quirk is a unique ability that can be inherited, and he has chosen Izuku to be his successor! Enduring many months of grueling training, Izuku enrolls in UA High, a prestigious high school famous for its excellent hero training program, and this year's freshmen look especially promising. With his bizarre but talented classmates and the looming threat of a villainous organization, Izuku will soon learn what it really means to be a hero.",
+                 created_at=datetime.datetime.now(),
+                 updated_at=datetime.datetime.now(),
+                 category=category4,
+                 user=user1)
+
+    item7 = Item(name="Toradora!",
+                 description="Ryuuji Takasu is a gentle high school student with a love for housework; but in contrast to his kind nature, he has an intimidating face that often gets him labeled as a delinquent. On the other hand is Taiga Aisaka, a small, doll-like student, who is anything but a cute and fragile girl. Equipped with a wooden katana and feisty personality, Taiga is known throughout the school as the 'Palmtop Tiger.'One day, an embarrassing mistake causes the two students to cross paths. Ryuuji discovers that Taiga actually has a sweet side: she has a crush on the popular vice president, Yuusaku Kitamura, who happens to be his best friend. But things only get crazier when Ryuuji reveals that he has a crush on Minori Kushieda—Taiga's best friend!Toradora! is a romantic comedy that follows this odd duo as they embark on a quest to help each other with their respective crushes, forming an unlikely alliance in the process.",
+                 created_at=datetime.datetime.now(),
+                 updated_at=datetime.datetime.now(),
+                 category=category5,
+                 user=user1)
+
+    item8 = Item(name="Another",
+                 description="In 1972, a popular student in Yomiyama North Middle School's class 3-3 named Misaki passed away during the school year. Since then, the town of Yomiyama has been shrouded by a fearful atmosphere, from the dark secrets hidden deep within.Twenty-six years later, 15-year-old Kouichi Sakakibara transfers into class 3-3 of Yomiyama North and soon after discovers that a strange, gloomy mood seems to hang over all the students. He also finds himself drawn to the mysterious, eyepatch-wearing student Mei Misaki; however, the rest of the class and the teachers seem to treat her like she doesn't exist. Paying no heed to warnings from everyone including Mei herself, Kouichi begins to get closer not only to her, but also to the truth behind the gruesome phenomenon plaguing class 3-3 of Yomiyama North.Another follows Kouichi, Mei, and their classmates as they are pulled into the enigma surrounding a series of inevitable, tragic events—but unraveling the horror of Yomiyama may just cost them the ultimate price.",
+                 created_at=datetime.datetime.now(),
+                 updated_at=datetime.datetime.now(),
+                 category=category6,
+                 user=user1)
+
+    item9 = Item(name="Haikyuu!!",
+                 description="Inspired after watching a volleyball ace nicknamed 'Little Giant' in action, small-statured Shouyou Hinata revives the volleyball club at his middle school. The newly-formed team even makes it to a tournament; however, their first match turns out to be their last when they are brutally squashed by the 'King of the Court,' Tobio Kageyama. Hinata vows to surpass Kageyama, and so after graduating from middle school, he joins Karasuno High School's volleyball team—only to find that his sworn rival, Kageyama, is now his teammate.Thanks to his short height, Hinata struggles to find his role on the team, even with his superior jumping power. Surprisingly, Kageyama has his own problems that only Hinata can help with, and learning to work together appears to be the only way for the team to be successful. Based on Haruichi Furudate's popular shounen manga of the same name, Haikyuu!! is an exhilarating and emotional sports comedy following two determined athletes as they attempt to patch a heated rivalry in order to make their high school volleyball team the best in Japan.",
+                 created_at=datetime.datetime.now(),
+                 updated_at=datetime.datetime.now(),
+                 category=category7,
+                 user=user1)
+
+    db_session.add(item1)
+    db_session.add(item2)
+    db_session.add(item3)
+    db_session.add(item4)
+    db_session.add(item5)
+    db_session.add(item6)
+    db_session.add(item7)
+    db_session.add(item8)
+    db_session.add(item9)
+
+    # COmmit created items to the db
+    db_session.commit()
+
+    # Items were added without going through the routes that count them
+    rebuildStats(db_session)
+    db_session.commit()
+
+
+# Words synthetic names and descriptions are drawn from
+WORDS = (
+    'academy adventure alchemist ancient army battle blade brother castle '
+    'city class clan club curse darkness demon destiny dragon dream empire '
+    'family father fate fight forest friend ghost girl god guild hero '
+    'hidden high hunter island journey king kingdom knight legend life '
+    'light lost magic master memory monster moon mountain mystery night '
+    'ninja ocean power prince princess quest rival school sea secret '
+    'shadow sister sky soul spirit star storm student summer sword team '
+    'titan tournament tower town village war warrior water wind winter '
+    'wish witch world young the of and a to in is that his her their '
+    'with for as on by from but must will when they only'
+).split()
+
+GENRES = ['Action', 'Adventure', 'Comedy', 'Demons', 'Drama', 'Fantasy',
+          'Horror', 'Isekai', 'Mecha', 'Music', 'Mystery', 'Romance',
+          'School', 'Sci-Fi', 'Shounen', 'Slice of Life', 'Sports',
+          'Supernatural', 'Thriller']
+
+
+def chunked(rows, size):
+    """Splits an iterable of rows into lists of at most size rows."""
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def report(label, count, elapsed):
+    print('%s: %d rows in %.2fs (%d rows/sec)' % (
+        label, count, elapsed, count / elapsed if elapsed else count))
+
+
+def insertRows(table, rows, chunk_size, transaction_size):
+    """Inserts rows with executemany, chunk_size rows per statement.
+
+    A transaction is committed every transaction_size rows, which keeps
+    the number of commits (and fsyncs) small.
+    """
+    started = time.time()
+    count = pending = 0
+    with engine.connect() as connection:
+        transaction = connection.begin()
+        for chunk in chunked(rows, chunk_size):
+            connection.execute(table.insert(), chunk)
+            count += len(chunk)
+            pending += len(chunk)
+            if pending >= transaction_size:
+                transaction.commit()
+                transaction = connection.begin()
+                pending = 0
+        transaction.commit()
+    report(table.name, count, time.time() - started)
+    return count
+
+
+def loadIds(column, start):
+    """Returns the ids in column greater than start."""
+    with engine.connect() as connection:
+        return [row[0] for row in connection.execute(
+            select(column).where(column > start))]
+
+
+def maxId(column):
+    with engine.connect() as connection:
+        return connection.execute(
+            select(column).order_by(column.desc()).limit(1)).scalar() or 0
+
+
+def generateUsers(count, first_id):
+    for n in range(first_id, first_id + count):
+        yield {'name': 'User %d' % n, 'email': 'user%d@example.com' % n}
+
+
+def generateCategories(count, first_id):
+    now = datetime.datetime.now()
+    for n in range(first_id, first_id + count):
+        name = GENRES[(n - 1) % len(GENRES)]
+        if n > len(GENRES):
+            name = '%s %d' % (name, (n - 1) // len(GENRES) + 1)
+        yield {'name': name, 'version': 0, 'updated_at': now}
+
+
+def generateItems(count, category_ids, user_ids, description_words, rng):
+    """Yields items with creation times spread over the last five years."""
+    now = datetime.datetime.now()
+    start = now - datetime.timedelta(days=5 * 365)
+    step = (now - start) / max(count, 1)
+    # Descriptions are cut from one long random text, which is much faster
+    # than drawing every word separately
+    longest = description_words * 3 // 2
+    text = rng.choices(WORDS, k=max(100000, longest * 2))
+    for n in range(count):
+        created_at = start + step * n
+        length = rng.randint(description_words // 2, longest)
+        offset = rng.randint(0, len(text) - longest)
+        name = ' '.join(rng.choices(WORDS, k=rng.randint(2, 5))).title()
+        yield {
+            'name': name[:80],
+            'description': ' '.join(
+                text[offset:offset + length]).capitalize(),
+            'created_at': created_at,
+            'updated_at': created_at,
+            'category_id': rng.choice(category_ids),
+            'user_id': rng.choice(user_ids)
+        }
+
+
+def dropItemIndexes():
+    """Drops the item indexes and search triggers before a bulk load."""
+    with engine.begin() as connection:
+        for index in Item.__table__.indexes:
+            index.drop(bind=connection, checkfirst=True)
+        if engine.dialect.name == 'sqlite':
+            dropSearchTriggers(connection)
+
+
+def restoreItemIndexes():
+    """Recreates what dropItemIndexes removed and refills the search index."""
+    started = time.time()
+    createIndexes(engine)
+    if engine.dialect.name == 'sqlite':
+        with engine.begin() as connection:
+            rebuildSearchIndex(connection)
+    print('indexes rebuilt in %.2fs' % (time.time() - started))
+
+
+def seedSynthetic(args):
+    """Bulk loads a synthetic catalog of the requested size."""
+    rng = random.Random(args.seed)
+    started = time.time()
+    total = 0
+
+    first_user = maxId(User.id)
+    total += insertRows(User.__table__,
+                        generateUsers(args.users, first_user + 1),
+                        args.chunk_size, args.transaction_size)
+    first_category = maxId(Category.id)
+    total += insertRows(Category.__table__,
+                        generateCategories(args.categories, first_category + 1),
+                        args.chunk_size, args.transaction_size)
+
+    if args.items:
+        # New items go to the new users and categories when there are any
+        user_ids = (loadIds(User.id, first_user) or
+                    loadIds(User.id, 0))
+        category_ids = (loadIds(Category.id, first_category) or
+                        loadIds(Category.id, 0))
+        if not user_ids or not category_ids:
+            raise SystemExit('items need at least one user and category')
+
+        if args.no_indexes:
+            dropItemIndexes()
+        try:
+            total += insertRows(
+                Item.__table__,
+                generateItems(args.items, category_ids, user_ids,
+                              args.description_words, rng),
+                args.chunk_size, args.transaction_size)
+        finally:
+            if args.no_indexes:
+                restoreItemIndexes()
+
+        # Count the new items once instead of on every insert
+        stats_started = time.time()
+        db_session = DBSession()
+        rebuildStats(db_session, category_ids, user_ids)
+        db_session.commit()
+        db_session.close()
+        print('statistics rebuilt in %.2fs' % (time.time() - stats_started))
+
+    report('total', total, time.time() - started)
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=0,
+                        help='number of synthetic users to add')
+    parser.add_argument('--categories', type=int, default=0,
+                        help='number of synthetic categories to add')
+    parser.add_argument('--items', type=int, default=0,
+                        help='number of synthetic items to add')
+    parser.add_argument('--description-words', type=int, default=150,
+                        help='average number of words per description')
+    parser.add_argument('--chunk-size', type=int, default=5000,
+                        help='rows per INSERT statement')
+    parser.add_argument('--transaction-size', type=int, default=100000,
+                        help='rows per transaction')
+    parser.add_argument('--no-indexes', action='store_true',
+                        help='drop item indexes during the load and '
+                             'rebuild them afterwards')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed for reproducible catalogs')
+    parser.add_argument('--database-url', default=DATABASE_URL,
+                        help='database to seed (default %(default)s)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parseArgs()
+    connect(args.database_url)
+    if args.users or args.categories or args.items:
+        seedSynthetic(args)
+    else:
+        seedAnime()
+        # Print completion message
+        print("added catalog items!")
@@ -0,0 +1,148 @@
+"""Item counts and newest items kept on every category and user.
+
+Category and User each carry item_count, last_added_at and
+latest_item_id, so pages and /api/stats never count the item table. The
+write paths adjust them in the same transaction as the item change: a new
+item adds one and may become the latest, a removed item subtracts one and
+if it was the latest, the next newest is looked up through the
+(category_id, created_at) or (user_id, created_at) index.
+
+Run this module to recompute every aggregate, e.g. after a bulk load or
+an upgrade, or with --check to only report the ones that are wrong:
+    python stats.py [--check]
+"""
+import argparse
+import sys
+
+from sqlalchemy import and_, case, func, or_, select
+
+from db_setup import Category, Item, User
+
+# The column of Item that links it to each model with aggregates
+OWNER_COLUMNS = ((Category, Item.category_id), (User, Item.user_id))
+
+
+def newest(column, key, value=Item.id):
+    """Returns value of the newest item linked to key as a scalar subquery.
+
+    Each value gets its own subquery; nesting them would make the inner
+    one correlate to the outer item instead of to key.
+    """
+    return select(value).where(column == key).order_by(
+        Item.created_at.desc(), Item.id.desc()).limit(1).scalar_subquery()
+
+
+def addItem(db_session, model, key, item_id, created_at):
+    """Counts an item in a category or user and maybe makes it latest."""
+    is_newer = or_(
+        model.last_added_at.is_(None),
+        model.last_added_at < created_at,
+        and_(model.last_added_at == created_at,
+             model.latest_item_id < item_id))
+    # Every right-hand side sees the row as it was before the update
+    db_session.query(model).filter(model.id == key).update({
+        model.item_count: model.item_count + 1,
+        model.latest_item_id: case(
+            (is_newer, item_id), else_=model.latest_item_id),
+        model.last_added_at: case(
+            (is_newer, created_at), else_=model.last_added_at)
+    }, synchronize_session=False)
+
+
+def removeItem(db_session, model, column, key, item_id):
+    """Uncounts an item that has already been deleted or moved away."""
+    was_latest = model.latest_item_id == item_id
+    db_session.query(model).filter(model.id == key).update({
+        model.item_count: model.item_count - 1,
+        model.latest_item_id: case((was_latest, newest(column, key)),
+                                   else_=model.latest_item_id),
+        model.last_added_at: case(
+            (was_latest, newest(column, key, Item.created_at)),
+            else_=model.last_added_at)
+    }, synchronize_session=False)
+
+
+def itemCreated(db_session, item):
+    """Counts a new item, which must have been flushed to get its id."""
+    addItem(db_session, Category, item.category_id, item.id, item.created_at)
+    addItem(db_session, User, item.user_id, item.id, item.created_at)
+
+
+def itemDeleted(db_session, item):
+    """Uncounts an item whose delete has been flushed."""
+    removeItem(db_session, Category, Item.category_id, item.category_id,
+               item.id)
+    removeItem(db_session, User, Item.user_id, item.user_id, item.id)
+
+
+def itemMoved(db_session, item, old_category_id):
+    """Moves an item's count to its new category after a flush."""
+    removeItem(db_session, Category, Item.category_id, old_category_id,
+               item.id)
+    addItem(db_session, Category, item.category_id, item.id, item.created_at)
+
+
+def computed(model, column):
+    """Returns the correct aggregates of model as correlated subqueries."""
+    return {
+        model.item_count: select(func.count(Item.id)).where(
+            column == model.id).scalar_subquery(),
+        model.latest_item_id: newest(column, model.id),
+        model.last_added_at: newest(column, model.id, Item.created_at)
+    }
+
+
+def rebuildStats(db_session, category_ids=None, user_ids=None):
+    """Recomputes the aggregates of the given, or all, categories and users.
+
+    Costs one index range scan per category or user, so the write paths
+    only use it for batches too large to adjust item by item.
+    """
+    for (model, column), ids in zip(OWNER_COLUMNS, (category_ids, user_ids)):
+        query = db_session.query(model)
+        if ids is not None:
+            if not ids:
+                continue
+            query = query.filter(model.id.in_(ids))
+        query.update(computed(model, column), synchronize_session=False)
+
+
+def checkStats(db_session):
+    """Returns a description of every aggregate that is wrong."""
+    problems = []
+    for model, column in OWNER_COLUMNS:
+        expected = computed(model, column)
+        stored = [model.item_count, model.latest_item_id, model.last_added_at]
+        rows = db_session.query(
+            model.id, *(stored + [expected[c] for c in stored]))
+        for row in rows:
+            for n, attribute in enumerate(stored):
+                if row[1 + n] != row[1 + len(stored) + n]:
+                    problems.append('%s %d: %s is %r, should be %r' % (
+                        model.__tablename__, row[0], attribute.key,
+                        row[1 + n], row[1 + len(stored) + n]))
+    return problems
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--check', action='store_true',
+                        help='only report wrong aggregates')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    from sqlalchemy.orm import sessionmaker
+    from db_setup import createEngine
+
+    args = parseArgs()
+    db_session = sessionmaker(bind=createEngine())()
+    if args.check:
+        problems = checkStats(db_session)
+        for problem in problems:
+            print(problem)
+        print('%d wrong aggregates' % len(problems))
+        sys.exit(1 if problems else 0)
+    rebuildStats(db_session)
+    db_session.commit()
+    print('item statistics rebuilt!')